@@ -0,0 +1,44 @@
+# Compare the cost of building a response envelope through jsonify with
+# encoding it straight to a Response. Run from the repository root:
+#
+#   python bench/envelope_bench.py [n_iterations]
+
+from sys import argv
+from timeit import timeit
+
+from flask import Flask, Response, jsonify
+
+from uchicagoldrapicore.responses.apiresponse import APIResponse
+
+from uchicagoldrhrapi.jsoncodec import fast_dumps, std_dumps
+
+
+def main():
+    n_iterations = int(argv[1]) if len(argv) > 1 else 20000
+    app = Flask(__name__)
+    small = {"record_identifier": "0123456789abcdef",
+             "key": "title", "value": "A title"}
+    large = {"record_identifier": "0123456789abcdef",
+             "record": dict(("field{}".format(i), {"value": str(i)})
+                            for i in range(500))}
+    paths = (
+        ("jsonify", lambda r: jsonify(r.dictify())),
+        ("Response + std_dumps",
+         lambda r: Response(std_dumps(r.dictify()),
+                            mimetype="application/json")),
+        ("Response + fast_dumps",
+         lambda r: Response(fast_dumps(r.dictify()),
+                            mimetype="application/json"))
+    )
+    with app.test_request_context():
+        for size, data in (("small", small), ("large", large)):
+            for name, path in paths:
+                t = timeit(lambda: path(APIResponse("success", data=data)),
+                           number=n_iterations)
+                print("{} envelope, {}: {:.2f}us".format(
+                    size, name, t / n_iterations * 1000000
+                ))
+
+
+if __name__ == "__main__":
+    main()
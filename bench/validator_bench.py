@@ -0,0 +1,54 @@
+# Compare RecordValidator against CompiledRecordValidator on a conf
+# with a few hundred rules. Run from the repository root:
+#
+#   python bench/validator_bench.py [n_rules] [n_iterations]
+
+from sys import argv, exit
+from timeit import timeit
+
+from hierarchicalrecord.hierarchicalrecord import HierarchicalRecord
+from hierarchicalrecord.recordconf import RecordConf
+from hierarchicalrecord.recordvalidator import RecordValidator
+
+from uchicagoldrhrapi.compiledvalidator import CompiledRecordValidator
+
+
+def build(n_rules):
+    conf = RecordConf()
+    record = HierarchicalRecord()
+    data = {}
+    for i in range(n_rules):
+        section = "Section{}".format(i % 10)
+        field = "Field{}".format(i)
+        conf.add_rule({
+            "Field Name": "{}.{}".format(section, field),
+            "Obligation": "r" if i % 2 else "o",
+            "Cardinality": "1" if i % 3 else "n",
+            "Value Type": "str",
+            "Validation": "^[a-z0-9]+$"
+        })
+        data.setdefault(section, {})[field] = "value{}".format(i)
+    record.data = data
+    return conf, record
+
+
+def main():
+    n_rules = int(argv[1]) if len(argv) > 1 else 500
+    n_iterations = int(argv[2]) if len(argv) > 2 else 100
+    conf, record = build(n_rules)
+    interpreted = RecordValidator(conf)
+    compiled = CompiledRecordValidator(conf)
+    expected = interpreted.validate(record)
+    actual = compiled.validate(record)
+    if actual != expected:
+        # Timings are meaningless if the results differ
+        exit("Validators disagree:\nRecordValidator: {}\n".format(expected) +
+             "CompiledRecordValidator: {}".format(actual))
+    for name, v in (("RecordValidator", interpreted),
+                    ("CompiledRecordValidator", compiled)):
+        t = timeit(lambda: v.validate(record), number=n_iterations)
+        print("{}: {:.3f}ms/validation".format(name, t / n_iterations * 1000))
+
+
+if __name__ == "__main__":
+    main()
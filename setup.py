@@ -30,5 +30,15 @@ setup(
     install_requires = [
         'uchicagoldrapicore',
         'hierarchicalrecord'
-    ]
+    ],
+    extras_require = {
+        'fast': ['orjson'],
+        'zstd': ['zstandard'],
+        'test': ['pytest', 'hierarchicalrecord']
+    },
+    entry_points = {
+        'console_scripts': [
+            'hrapi-integrity = uchicagoldrhrapi.integrity:main'
+        ]
+    }
 )
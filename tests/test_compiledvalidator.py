@@ -0,0 +1,109 @@
+from itertools import product
+
+import pytest
+
+# No importorskip here: hierarchicalrecord is an install requirement, and
+# these tests are what makes COMPILED_VALIDATORS safe to turn on, so they
+# must never pass by being skipped
+from hierarchicalrecord.hierarchicalrecord import HierarchicalRecord
+from hierarchicalrecord.recordconf import RecordConf
+from hierarchicalrecord.recordvalidator import RecordValidator
+
+from uchicagoldrhrapi.compiledvalidator import CompiledRecordValidator
+
+
+# CompiledRecordValidator has to be a drop in replacement, so every
+# (validity, errors) pair it produces must match RecordValidator's exactly
+
+OBLIGATIONS = ["r", "o"]
+CARDINALITIES = ["1", "n"]
+VALUE_TYPES = ["str", "int", "dict", "bool", ""]
+VALIDATIONS = ["", "^[a-z]+$"]
+
+VALUES = [
+    None,           # key absent
+    "abc",
+    "ABC",
+    1,
+    True,
+    {"Child": "abc"},
+    ["abc", "def"],
+    ["abc", 1]
+]
+
+
+def build_conf(rules):
+    conf = RecordConf()
+    for rule in rules:
+        conf.add_rule(dict(rule))
+    return conf
+
+
+def build_record(data):
+    r = HierarchicalRecord()
+    r.data = data
+    return r
+
+
+def assert_same(conf, data):
+    expected = RecordValidator(conf).validate(build_record(data))
+    actual = CompiledRecordValidator(conf).validate(build_record(data))
+    assert actual == expected, data
+
+
+@pytest.mark.parametrize(
+    "obligation,cardinality,value_type,validation",
+    list(product(OBLIGATIONS, CARDINALITIES, VALUE_TYPES, VALIDATIONS))
+)
+def test_top_level_rule_parity(obligation, cardinality, value_type,
+                               validation):
+    conf = build_conf([{"Field Name": "Field",
+                        "Obligation": obligation,
+                        "Cardinality": cardinality,
+                        "Value Type": value_type,
+                        "Validation": validation}])
+    for value in VALUES:
+        data = {} if value is None else {"Field": value}
+        assert_same(conf, data)
+
+
+@pytest.mark.parametrize(
+    "parent_obligation,child_obligation,cardinality",
+    list(product(OBLIGATIONS, OBLIGATIONS, CARDINALITIES))
+)
+def test_nested_rule_parity(parent_obligation, child_obligation,
+                            cardinality):
+    conf = build_conf([
+        {"Field Name": "Parent", "Obligation": parent_obligation,
+         "Cardinality": cardinality, "Value Type": "dict",
+         "Validation": ""},
+        {"Field Name": "Parent.Child", "Obligation": child_obligation,
+         "Cardinality": "1", "Value Type": "str",
+         "Validation": "^[a-z]+$"}
+    ])
+    for data in [
+        {},
+        {"Parent": {}},
+        {"Parent": {"Child": "abc"}},
+        {"Parent": {"Child": "ABC"}},
+        {"Parent": [{"Child": "abc"}, {}]},
+        {"Parent": [{"Child": "abc"}, {"Child": "def"}]},
+        {"Parent": {"Child": ["abc", "def"]}}
+    ]:
+        assert_same(conf, data)
+
+
+def test_many_rules_parity():
+    rules = []
+    data = {}
+    for i in range(300):
+        section = "Section{}".format(i % 10)
+        rules.append({"Field Name": "{}.Field{}".format(section, i),
+                      "Obligation": OBLIGATIONS[i % 2],
+                      "Cardinality": CARDINALITIES[i % 2],
+                      "Value Type": "str",
+                      "Validation": VALIDATIONS[i % 2]})
+        if i % 3:
+            data.setdefault(section, {})["Field{}".format(i)] = \
+                "value" if i % 5 else "VALUE{}".format(i)
+    assert_same(build_conf(rules), data)
@@ -0,0 +1,146 @@
+from gzip import decompress as gunzip
+from zlib import decompressobj, MAX_WBITS
+
+import pytest
+from werkzeug.http import parse_accept_header
+from werkzeug.wrappers import Response
+
+from uchicagoldrhrapi import compression
+from uchicagoldrhrapi.compression import choose_encoding, compress, \
+    compress_response, compress_stream
+
+
+BODY = b'{"Title": "Something", "Dates": [1900, 1901]}' * 100
+
+
+def accept(value):
+    return parse_accept_header(value)
+
+
+@pytest.fixture
+def both(monkeypatch):
+    # Negotiation doesn't need the zstandard package itself
+    monkeypatch.setattr(compression, "available_encodings",
+                        lambda: ["zstd", "gzip"])
+
+
+@pytest.mark.parametrize("header,expected", [
+    ("", None),
+    ("identity", None),
+    ("gzip", "gzip"),
+    ("br, gzip;q=0.5", "gzip"),
+    ("gzip;q=0", None),
+    ("*", "gzip"),
+    ("gzip;q=0, *", None),
+])
+def test_choose_encoding_gzip_only(monkeypatch, header, expected):
+    monkeypatch.setattr(compression, "available_encodings", lambda: ["gzip"])
+    assert choose_encoding(accept(header)) == expected
+
+
+@pytest.mark.parametrize("header,expected", [
+    ("gzip, zstd", "zstd"),
+    ("zstd;q=0.5, gzip", "gzip"),
+    ("gzip;q=0.9, zstd;q=0.1", "gzip"),
+    ("zstd;q=0, gzip;q=0.1", "gzip"),
+    ("*", "zstd"),
+    ("zstd;q=0, *", "gzip"),
+    ("*;q=0.5, gzip", "gzip"),
+    ("zstd;q=0, gzip;q=0", None),
+])
+def test_choose_encoding(both, header, expected):
+    assert choose_encoding(accept(header)) == expected
+
+
+def test_compress_response():
+    r = compress_response(Response(BODY), accept("gzip"))
+    assert r.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in r.vary
+    assert int(r.headers["Content-Length"]) == len(r.get_data())
+    assert gunzip(r.get_data()) == BODY
+
+
+def test_size_threshold():
+    r = compress_response(Response(BODY[:100]), accept("gzip"), min_size=101)
+    assert "Content-Encoding" not in r.headers
+    assert "Accept-Encoding" in r.vary
+    assert r.get_data() == BODY[:100]
+    r = compress_response(Response(BODY[:100]), accept("gzip"), min_size=100)
+    assert gunzip(r.get_data()) == BODY[:100]
+
+
+def test_levels():
+    fast = compress_response(Response(BODY), accept("gzip"),
+                             levels={"gzip": 1})
+    assert gunzip(fast.get_data()) == BODY
+
+
+def test_no_acceptable_encoding():
+    r = compress_response(Response(BODY), accept("gzip;q=0"))
+    assert "Content-Encoding" not in r.headers
+    assert r.get_data() == BODY
+
+
+@pytest.mark.parametrize("status,headers", [
+    (206, {"Content-Range": "bytes 0-9/100"}),
+    (200, {"Content-Range": "bytes 0-9/100"}),
+    (200, {"Content-Encoding": "gzip"}),
+    (204, {}),
+    (304, {}),
+])
+def test_skipped_responses(status, headers):
+    r = compress_response(Response(BODY, status=status, headers=headers),
+                          accept("gzip"))
+    assert r.headers.get("Content-Encoding") == \
+        headers.get("Content-Encoding")
+    assert r.get_data() == BODY
+
+
+def test_streamed_response():
+    chunks = [BODY[i:i+500] for i in range(0, len(BODY), 500)]
+    r = compress_response(Response(iter(chunks),
+                                   headers={"Content-Length": len(BODY)}),
+                          accept("gzip"))
+    assert r.headers["Content-Encoding"] == "gzip"
+    # The compressed length can't be known up front
+    assert "Content-Length" not in r.headers
+    assert gunzip(b"".join(r.response)) == BODY
+
+
+def test_streamed_chunks_decode_as_they_arrive():
+    # Every chunk has to be decodable as soon as it's sent, otherwise a
+    # client sees nothing until the stream ends
+    chunks = [b"", "text, ", b'{"n": 1}\n', b"", b"x" * 5000, b"end"]
+    d = decompressobj(MAX_WBITS | 16)
+    out = compress_stream(iter(chunks), "gzip", 6)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        if not chunk:
+            continue
+        received = next(out)
+        assert received
+        assert d.decompress(received) == chunk
+    # Then the end of the stream
+    assert d.decompress(b"".join(out)) == b""
+    d.flush()
+    assert d.eof
+
+
+def test_compress_round_trip():
+    assert gunzip(compress(BODY, "gzip", 6)) == BODY
+    with pytest.raises(ValueError):
+        compress(BODY, "br", 6)
+
+
+def test_zstd():
+    zstandard = pytest.importorskip("zstandard")
+    d = zstandard.ZstdDecompressor().decompressobj()
+    assert zstandard.ZstdDecompressor().decompress(
+        compress(BODY, "zstd", 3), max_output_size=len(BODY)
+    ) == BODY
+    for chunk, received in zip([BODY[:100], BODY[100:]],
+                               compress_stream(iter([BODY[:100],
+                                                     BODY[100:]]),
+                                               "zstd", 3)):
+        assert d.decompress(received) == chunk
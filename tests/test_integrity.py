@@ -0,0 +1,305 @@
+from json import dumps, load
+from os import makedirs, utime, walk
+from os.path import exists, join
+from time import time
+
+import pytest
+
+from uchicagoldrhrapi.integrity import ScanError, check_categories, \
+    check_confs, check_history, check_records, check_tmp, scan
+from uchicagoldrhrapi.recordhistory import RecordHistory
+
+
+CONF_HEADER = "Field Name,Obligation,Cardinality,Value Type,Validation\n"
+
+
+@pytest.fixture
+def root(tmp_path):
+    for x in ('records', 'confs', 'org', 'history', 'tmp'):
+        makedirs(str(tmp_path / x))
+    return str(tmp_path)
+
+
+def write(root, area, name, text):
+    with open(join(root, area, name), 'w') as f:
+        f.write(text)
+
+
+def read(root, area, name):
+    with open(join(root, area, name), 'r') as f:
+        return load(f)
+
+
+def add_record(root, name, versions=()):
+    # Writes the record, and its history if there is any, the way the API
+    # does
+    history = RecordHistory(join(root, 'history'), snapshot_interval=3)
+    for v in versions:
+        history.add_version(name, v)
+    write(root, 'records', name, dumps(versions[-1] if versions else {}))
+    return history
+
+
+def age(root):
+    # Anything modified after a scan starts is skipped, so make everything
+    # look like it was written well before
+    then = time() - 100
+    for d, dirs, files in walk(root):
+        for x in files + dirs:
+            utime(join(d, x), (then, then))
+
+
+def problems(findings):
+    return sorted((x['area'], x['name'], x['problem'], x['action'])
+                  for x in findings)
+
+
+def test_good_root_has_no_findings(root):
+    add_record(root, "a", [{"n": i} for i in range(5)])
+    add_record(root, "b")
+    write(root, 'org', "c", "a\nb\n")
+    write(root, 'confs', "d.csv", CONF_HEADER + "Title,r,1,str,\n")
+    age(root)
+    assert scan(root, workers=1, quiet=True) == []
+
+
+def test_corrupt_record_without_history_is_quarantined(root):
+    write(root, 'records', "a", '{"Title": "trunc')
+    age(root)
+    findings = check_records(root, ["a"], False, time())
+    assert problems(findings) == [('records', 'a', 'corrupt', '')]
+    assert exists(join(root, 'records', "a"))
+    findings = check_records(root, ["a"], True, time())
+    assert problems(findings) == [('records', 'a', 'corrupt', 'quarantined')]
+    assert not exists(join(root, 'records', "a"))
+    assert exists(join(root, 'quarantine', 'records', "a"))
+
+
+def test_corrupt_record_is_restored_from_history(root):
+    add_record(root, "a", [{"n": i} for i in range(5)])
+    write(root, 'records', "a", '{"n": ')
+    age(root)
+    findings = check_records(root, ["a"], True, time())
+    assert problems(findings) == [
+        ('records', 'a', 'corrupt', 'restored version 5')
+    ]
+    assert read(root, 'records', "a") == {"n": 4}
+    assert exists(join(root, 'quarantine', 'records', "a"))
+
+
+def test_non_object_record_is_corrupt(root):
+    write(root, 'records', "a", '[1, 2]')
+    age(root)
+    assert problems(check_records(root, ["a"], False, time())) == [
+        ('records', 'a', 'corrupt', '')
+    ]
+
+
+def test_bad_record_identifier(root):
+    write(root, 'records', "a.tmp", '{}')
+    age(root)
+    assert problems(check_records(root, ["a.tmp"], True, time())) == [
+        ('records', 'a.tmp', 'bad_identifier', 'quarantined')
+    ]
+
+
+def test_records_changed_during_scan_are_skipped(root):
+    write(root, 'records', "a", '{"n": ')
+    started = time() - 10
+    assert problems(check_records(root, ["a"], True, started)) == [
+        ('records', 'a', 'changed_during_scan', 'skipped')
+    ]
+    assert exists(join(root, 'records', "a"))
+
+
+def test_corrupt_record_with_truncated_index(root):
+    # The index has to be rebuilt before the record can be restored
+    add_record(root, "a", [{"n": i} for i in range(5)])
+    write(root, 'records', "a", '{"n": ')
+    write(root, join('history', "a"), "index.json", '[{"version": 0, "ki')
+    age(root)
+    findings = check_records(root, ["a"], True, time())
+    assert problems(findings) == [
+        ('history', 'a', 'bad_index', 'rebuilt'),
+        ('records', 'a', 'corrupt', 'restored version 5'),
+    ]
+    assert read(root, 'records', "a") == {"n": 4}
+    assert [x['version'] for x in RecordHistory(
+        join(root, 'history')).versions("a")] == [1, 2, 3, 4, 5]
+
+
+def test_unreadable_index_falls_back_to_quarantine(root):
+    add_record(root, "a", [{"n": i} for i in range(5)])
+    write(root, 'records', "a", '{"n": ')
+    write(root, join('history', "a"), "index.json", '[{"version": 0, "ki')
+    age(root)
+    # The history changing during the scan means it isn't rebuilt, which
+    # leaves nothing to restore from
+    utime(join(root, 'history', "a"), None)
+    findings = check_records(root, ["a"], True, time() - 10)
+    assert problems(findings) == [
+        ('history', 'a', 'changed_during_scan', 'skipped'),
+        ('records', 'a', 'corrupt', 'quarantined'),
+    ]
+    assert not exists(join(root, 'records', "a"))
+
+
+def test_corrupt_record_with_truncated_index_scan(root):
+    add_record(root, "a", [{"n": i} for i in range(5)])
+    write(root, 'records', "a", '{"n": ')
+    write(root, join('history', "a"), "index.json", '[{"version": 0, "ki')
+    add_record(root, "b")
+    age(root)
+    # Used to abort the whole run
+    findings = scan(root, repair=True, workers=1, quiet=True)
+    assert problems(findings) == [
+        ('history', 'a', 'bad_index', 'rebuilt'),
+        ('records', 'a', 'corrupt', 'restored version 5'),
+    ]
+    assert read(root, 'records', "a") == {"n": 4}
+
+
+def test_dangling_members(root):
+    write(root, 'org', "c", "a\nb\na\n\nz\n")
+    age(root)
+    ids = frozenset(["a", "b"])
+    findings = check_categories(root, ["c"], False, time(), record_ids=ids)
+    assert problems(findings) == [('org', 'c', 'dangling_member', '')]
+    assert findings[0]['detail'] == "z"
+    findings = check_categories(root, ["c"], True, time(), record_ids=ids)
+    assert problems(findings) == [('org', 'c', 'dangling_member', 'removed')]
+    with open(join(root, 'org', "c"), 'r') as f:
+        assert f.read() == "a\nb\n"
+
+
+def test_members_of_quarantined_records_dangle(root):
+    add_record(root, "a")
+    write(root, 'records', "b", '{"n": ')
+    write(root, 'org', "c", "a\nb\n")
+    age(root)
+    findings = scan(root, repair=True, workers=1, quiet=True)
+    assert problems(findings) == [
+        ('org', 'c', 'dangling_member', 'removed'),
+        ('records', 'b', 'corrupt', 'quarantined'),
+    ]
+
+
+def test_orphaned_history(root):
+    add_record(root, "a", [{"n": 1}])
+    RecordHistory(join(root, 'history')).add_version("b", {"n": 1})
+    age(root)
+    ids = frozenset(["a"])
+    findings = check_history(root, ["a", "b"], True, time(), record_ids=ids)
+    assert problems(findings) == [('history', 'b', 'orphaned', 'quarantined')]
+    assert exists(join(root, 'history', "a"))
+    assert exists(join(root, 'quarantine', 'history', "b"))
+
+
+def test_missing_index_is_rebuilt(root):
+    history = add_record(root, "a", [{"n": i} for i in range(7)])
+    expected = history.versions("a")
+    write(root, join('history', "a"), "index.json", "")
+    age(root)
+    ids = frozenset(["a"])
+    findings = check_history(root, ["a"], False, time(), record_ids=ids)
+    assert problems(findings) == [('history', 'a', 'bad_index', '')]
+    findings = check_history(root, ["a"], True, time(), record_ids=ids)
+    assert problems(findings) == [('history', 'a', 'bad_index', 'rebuilt')]
+    assert [x['version'] for x in history.versions("a")] == \
+        [x['version'] for x in expected]
+    assert history.get_version("a", 7) == {"n": 6}
+    age(root)
+    assert check_history(root, ["a"], True, time(), record_ids=ids) == []
+
+
+def test_conf_problems(root):
+    write(root, 'confs', "good.csv", CONF_HEADER + "Title,r,1,str,\n")
+    write(root, 'confs', "empty.csv", "")
+    write(root, 'confs', "short.csv", CONF_HEADER + "Title,r,1,str,\nTi")
+    write(root, 'confs', "wide.csv", CONF_HEADER + "Title,r,1,str,,x\n")
+    write(root, 'confs', "columns.csv", "Field Name\nTitle\n")
+    write(root, 'confs', "bad-name.csv", CONF_HEADER)
+    # Longer than the csv module allows in a field
+    write(root, 'confs', "huge.csv",
+          CONF_HEADER + '"' + "x" * 200000 + '",r,1,str,\n')
+    age(root)
+    names = ["bad-name.csv", "columns.csv", "empty.csv", "good.csv",
+             "huge.csv", "short.csv", "wide.csv"]
+    findings = check_confs(root, names, True, time())
+    assert problems(findings) == [
+        ('confs', 'bad-name.csv', 'orphaned', 'quarantined'),
+        ('confs', 'columns.csv', 'unexpected_columns', ''),
+        ('confs', 'huge.csv', 'corrupt', 'quarantined'),
+        ('confs', 'short.csv', 'corrupt', 'quarantined'),
+        ('confs', 'wide.csv', 'corrupt', 'quarantined'),
+    ]
+    assert exists(join(root, 'confs', "columns.csv"))
+    assert exists(join(root, 'quarantine', 'confs', "huge.csv"))
+
+
+def test_missing_conf_fails_up_front(root):
+    state = join(root, "state")
+    with pytest.raises(ScanError):
+        scan(root, conf_id="missing", workers=1, state_path=state,
+             quiet=True)
+    with pytest.raises(ScanError):
+        scan(root, conf_id="../x", workers=1, quiet=True)
+    write(root, 'confs', "short.csv", CONF_HEADER + "Title,r\n")
+    with pytest.raises(ScanError):
+        scan(root, conf_id="short", workers=1, quiet=True)
+    assert not exists(state)
+
+
+def test_incomplete_writes(root):
+    write(root, 'tmp', "a.0123", '{"n": ')
+    write(root, 'tmp', "b.4567", '{"n": ')
+    age(root)
+    utime(join(root, 'tmp', "b.4567"), None)
+    findings = check_tmp(root, ["a.0123", "b.4567"], True, time() - 10)
+    assert problems(findings) == [
+        ('tmp', 'a.0123', 'incomplete_write', 'quarantined'),
+        ('tmp', 'b.4567', 'changed_during_scan', 'skipped'),
+    ]
+    assert exists(join(root, 'quarantine', 'tmp', "a.0123"))
+
+
+def test_resume_from_state(root):
+    for x in "abcde":
+        add_record(root, x)
+    write(root, 'records', "c", '{"n": ')
+    age(root)
+    state = join(root, "state")
+    first = scan(root, workers=1, chunk_size=2, state_path=state, quiet=True)
+    assert problems(first) == [('records', 'c', 'corrupt', '')]
+    # Already checked, so a resumed scan doesn't look at it again...
+    write(root, 'records', "a", '{"n": ')
+    # ...but does pick up files it hasn't seen
+    write(root, 'records', "f", '{"n": ')
+    age(root)
+    second = scan(root, workers=1, chunk_size=2, state_path=state,
+                  quiet=True)
+    assert problems(second) == [('records', 'c', 'corrupt', ''),
+                                ('records', 'f', 'corrupt', '')]
+    with pytest.raises(ScanError):
+        scan(root, repair=True, workers=1, state_path=state, quiet=True)
+
+
+def test_resume_after_torn_state(root):
+    add_record(root, "a")
+    write(root, 'records', "b", '{"n": ')
+    age(root)
+    state = join(root, "state")
+    scan(root, workers=1, chunk_size=1, state_path=state, quiet=True)
+    with open(state, 'a') as f:
+        f.write('{"area": "records", "na')
+    assert problems(scan(root, workers=1, state_path=state, quiet=True)) == [
+        ('records', 'b', 'corrupt', '')
+    ]
+
+
+def test_not_a_state_file(root):
+    state = join(root, "state")
+    with open(state, 'w') as f:
+        f.write('{"area": "records"}\n')
+    with pytest.raises(ScanError):
+        scan(root, workers=1, state_path=state, quiet=True)
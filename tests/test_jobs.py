@@ -0,0 +1,252 @@
+from json import dump, dumps
+from os import getpid, listdir
+from os.path import exists, join
+from socket import gethostname
+from subprocess import Popen
+from sys import executable
+from threading import Event
+from time import sleep, time
+
+import pytest
+
+from uchicagoldrhrapi.jobs import JobQueue
+
+
+def wait_for(queue, identifier, statuses=("finished", "failed", "cancelled",
+                                          "interrupted")):
+    deadline = time() + 10
+    while time() < deadline:
+        state = queue.get(identifier)
+        if state['status'] in statuses:
+            return state
+        sleep(0.01)
+    raise AssertionError("job {} never got to {}".format(identifier,
+                                                         statuses))
+
+
+def write_state(root, identifier, status, kind="add", params=None,
+                finished=None):
+    with open(join(root, identifier+".json"), 'w') as f:
+        dump({"job_identifier": identifier, "kind": kind,
+              "params": {"a": 1, "b": 2} if params is None else params,
+              "status": status,
+              "progress": {"done": 0, "total": None}, "result": None,
+              "error": None, "submitted": time(), "started": None,
+              "finished": finished}, f)
+
+
+def write_claim(root, identifier, pid):
+    with open(join(root, identifier+".claim"), 'w') as f:
+        f.write(dumps({"host": gethostname(), "pid": pid}))
+
+
+def dead_pid():
+    p = Popen([executable, "-c", "pass"])
+    p.wait()
+    return p.pid
+
+
+class Blocker(object):
+    # A job which reports progress until it's released or cancelled
+    def __init__(self):
+        self.started = Event()
+        self.release = Event()
+
+    def __call__(self, job):
+        self.started.set()
+        i = 0
+        while not self.release.is_set():
+            job.progress(i)
+            i += 1
+            sleep(0.01)
+        return "released"
+
+
+def add(job, a, b):
+    job.progress(1, 1)
+    return a + b
+
+
+def fail(job):
+    raise RuntimeError("broken")
+
+
+@pytest.fixture
+def make_queue(tmp_path):
+    queues = []
+
+    def make(**kwargs):
+        q = JobQueue(str(tmp_path / "jobs"), **kwargs)
+        q.register("add", add)
+        q.register("fail", fail)
+        queues.append(q)
+        return q
+    yield make
+    for q in queues:
+        q.shutdown(timeout=2)
+
+
+def test_submit_and_finish(make_queue):
+    q = make_queue()
+    state = q.submit("add", {"a": 1, "b": 2})
+    assert state['status'] in ("queued", "running", "finished")
+    state = wait_for(q, state['job_identifier'])
+    assert state['status'] == "finished"
+    assert state['result'] == 3
+    assert state['progress'] == {"done": 1, "total": 1}
+    assert state['started'] is not None and state['finished'] is not None
+    assert q.list() == [state['job_identifier']]
+    assert q.kinds() == ["add", "fail"]
+
+
+def test_failure_is_recorded(make_queue):
+    q = make_queue()
+    state = wait_for(q, q.submit("fail")['job_identifier'])
+    assert state['status'] == "failed"
+    assert state['error']['message'] == "broken"
+    assert "RuntimeError" in state['error']['traceback']
+
+
+def test_bad_submissions(make_queue):
+    q = make_queue()
+    with pytest.raises(ValueError):
+        q.submit("missing")
+    with pytest.raises(ValueError):
+        q.get("missing")
+    with pytest.raises(ValueError):
+        JobQueue(q.root, workers=0)
+
+
+def test_claimed_jobs_run_once(make_queue):
+    calls = []
+
+    def count(job):
+        calls.append(getpid())
+        return len(calls)
+    queues = [make_queue() for _ in range(3)]
+    for q in queues:
+        q.register("count", count)
+    for i in range(5):
+        write_state(queues[0].root, "job{}".format(i), "queued",
+                    kind="count", params={})
+    # Every queue sees every queued job, but only one gets to run each
+    for q in queues:
+        q.resume()
+    for i in range(5):
+        assert wait_for(queues[0], "job{}".format(i))['status'] == "finished"
+    sleep(0.1)
+    assert len(calls) == 5
+
+
+def test_already_claimed_job_is_left_alone(make_queue):
+    q = make_queue()
+    write_state(q.root, "job", "queued")
+    write_claim(q.root, "job", getpid())
+    q.resume()
+    sleep(0.2)
+    assert q.get("job")['status'] == "queued"
+
+
+def test_cancel_running(make_queue):
+    q = make_queue()
+    blocker = Blocker()
+    q.register("block", blocker)
+    identifier = q.submit("block")['job_identifier']
+    assert blocker.started.wait(5)
+    q.cancel(identifier)
+    assert wait_for(q, identifier)['status'] == "cancelled"
+    with pytest.raises(ValueError):
+        q.cancel(identifier)
+
+
+def test_cancel_queued(make_queue):
+    q = make_queue(workers=1)
+    blocker = Blocker()
+    q.register("block", blocker)
+    first = q.submit("block")['job_identifier']
+    assert blocker.started.wait(5)
+    second = q.submit("add", {"a": 1, "b": 2})['job_identifier']
+    q.cancel(second)
+    blocker.release.set()
+    assert wait_for(q, first)['status'] == "finished"
+    state = wait_for(q, second)
+    assert state['status'] == "cancelled"
+    assert state['result'] is None
+
+
+def test_cancel_from_another_process(make_queue):
+    q = make_queue()
+    other = make_queue()
+    blocker = Blocker()
+    q.register("block", blocker)
+    identifier = q.submit("block")['job_identifier']
+    assert blocker.started.wait(5)
+    # other isn't running it, so it can only leave a marker for q to find
+    other.cancel(identifier)
+    assert exists(join(q.root, identifier+".cancel"))
+    assert wait_for(q, identifier)['status'] == "cancelled"
+
+
+def test_resume(make_queue):
+    q = make_queue()
+    root = q.root
+    q.shutdown()
+    write_state(root, "queued", "queued")
+    write_state(root, "dead", "running")
+    write_claim(root, "dead", dead_pid())
+    write_state(root, "alive", "running")
+    write_claim(root, "alive", getpid())
+    write_state(root, "done", "finished", finished=time())
+    q = make_queue()
+    q.resume()
+    assert wait_for(q, "queued")['result'] == 3
+    assert q.get("dead")['status'] == "interrupted"
+    assert q.get("alive")['status'] == "running"
+    assert q.get("done")['status'] == "finished"
+
+
+def test_shutdown_interrupts_running_jobs(make_queue):
+    q = make_queue(workers=1)
+    blocker = Blocker()
+    q.register("block", blocker)
+    running = q.submit("block")['job_identifier']
+    assert blocker.started.wait(5)
+    queued = q.submit("add", {"a": 1, "b": 2})['job_identifier']
+    q.shutdown(timeout=5)
+    assert q.get(running)['status'] == "interrupted"
+    # Left for the next process to pick up
+    assert q.get(queued)['status'] == "queued"
+    assert not any(t.is_alive() for t in q._threads)
+
+
+def test_purge(make_queue):
+    q = make_queue()
+    root = q.root
+    now = time()
+    write_state(root, "old", "finished", finished=now - 100)
+    write_claim(root, "old", getpid())
+    with open(join(root, "old.cancel"), 'w'):
+        pass
+    write_state(root, "recent", "failed", finished=now)
+    write_state(root, "running", "running")
+    write_claim(root, "running", getpid())
+    assert q.purge(50) == ["old"]
+    assert sorted(listdir(root)) == ["recent.json", "running.claim",
+                                     "running.json"]
+    with pytest.raises(ValueError):
+        q.get("old")
+
+
+def test_retention(make_queue):
+    q = make_queue()
+    root = q.root
+    q.shutdown()
+    write_state(root, "old", "cancelled", finished=time() - 100)
+    q = make_queue(retention=50)
+    q.resume()
+    assert q.list() == []
+    write_state(root, "old", "interrupted", finished=time() - 100)
+    identifier = q.submit("add", {"a": 1, "b": 2})['job_identifier']
+    assert q.list() == [identifier]
+    with pytest.raises(ValueError):
+        make_queue(retention=-1)
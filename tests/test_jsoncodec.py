@@ -0,0 +1,40 @@
+import pytest
+from werkzeug.exceptions import BadRequest
+from werkzeug.wrappers import Request
+
+from uchicagoldrhrapi.jsoncodec import FastJSONModule, codec, std_dumps, \
+    std_loads
+
+
+def request(body):
+    r = Request.from_values(data=body, content_type="application/json")
+    r.json_module = FastJSONModule
+    return r
+
+
+def test_request_bodies():
+    body = '{"Title": "Café", "Dates": [1900, 1901], "Big": ' + \
+        str(2**70) + '}'
+    assert request(body.encode("utf-8")).get_json() == std_loads(body)
+
+
+def test_bad_request_bodies():
+    with pytest.raises(BadRequest):
+        request(b'{"Title": ').get_json()
+    assert request(b'{"Title": ').get_json(silent=True) is None
+
+
+def test_std_codec():
+    dumps, loads = codec(False)
+    assert dumps is std_dumps
+    assert dumps({"a": [1, "é"]}) == '{"a":[1,"é"]}'.encode("utf-8")
+    # What FAST_JSON would change
+    assert dumps({"a": float("nan")}) == b'{"a":NaN}'
+    assert loads(b'{"a":NaN}')['a'] != loads(b'{"a":NaN}')['a']
+
+
+def test_fast_dumps_round_trip():
+    obj = {"a": [1, 2.5, None, True], "b": {"c": "é"}, "d": 2**70}
+    dumps, loads = codec(True)
+    assert loads(dumps(obj)) == obj
+    assert std_loads(FastJSONModule.dumps(obj)) == obj
@@ -0,0 +1,104 @@
+from copy import deepcopy
+from os import listdir
+
+import pytest
+
+from uchicagoldrhrapi.recordhistory import RecordHistory, diff, patch
+
+
+def states(n):
+    # A run of record versions exercising additions, changes, removals,
+    # nested dicts, lists and type changes
+    r = []
+    for i in range(n):
+        s = {"Title": "Version {}".format(i),
+             "Creator": {"Name": "Someone", "Dates": [1900, 1900 + i]},
+             "Count": i if i % 4 else str(i)}
+        if i % 3:
+            s["Extent"] = {"Value": i, "Unit": "boxes"}
+        if i % 5 == 0:
+            s["Creator"]["Role"] = "author"
+        if i % 7 == 0:
+            s["Creator"] = "Anonymous"
+        r.append(s)
+    return r
+
+
+def test_diff_patch_round_trip():
+    versions = states(30)
+    for old, new in zip(versions, versions[1:]):
+        assert patch(deepcopy(old), diff(old, new)) == new
+
+
+def test_unknown_operation():
+    with pytest.raises(ValueError):
+        patch({}, [["move", ["a"]]])
+
+
+@pytest.mark.parametrize("snapshot_interval", [1, 2, 3, 10])
+def test_round_trip_across_snapshots(tmp_path, snapshot_interval):
+    h = RecordHistory(str(tmp_path), snapshot_interval=snapshot_interval)
+    versions = states(25)
+    for i, s in enumerate(versions):
+        assert h.add_version("rec", s) == i + 1
+    assert [x['version'] for x in h.versions("rec")] == \
+        list(range(1, 26))
+    for i, s in enumerate(versions):
+        assert h.get_version("rec", i + 1) == s
+    snapshots = [x for x in listdir(str(tmp_path / "rec"))
+                 if x.endswith(".snapshot.json")]
+    assert len(snapshots) == -(-25 // snapshot_interval)
+
+
+@pytest.mark.parametrize("keep", [1, 2, 4, 5, 9, 25, 30])
+def test_compact(tmp_path, keep):
+    h = RecordHistory(str(tmp_path), snapshot_interval=5)
+    versions = states(25)
+    for s in versions:
+        h.add_version("rec", s)
+    dropped = h.compact("rec", keep)
+    assert dropped == max(0, 25 - keep)
+    remaining = [x['version'] for x in h.versions("rec")]
+    assert remaining == list(range(max(1, 26 - keep), 26))
+    for v in remaining:
+        assert h.get_version("rec", v) == versions[v - 1]
+    for v in range(1, remaining[0]):
+        with pytest.raises(ValueError):
+            h.get_version("rec", v)
+    # Only the files the index refers to are left behind
+    assert len(listdir(str(tmp_path / "rec"))) == len(remaining) + 1
+    # and the history carries on correctly after compaction
+    extra = states(30)[25:]
+    for s in extra:
+        h.add_version("rec", s)
+    for i, s in enumerate(extra):
+        assert h.get_version("rec", 26 + i) == s
+
+
+def test_max_versions(tmp_path):
+    h = RecordHistory(str(tmp_path), snapshot_interval=4, max_versions=3)
+    versions = states(12)
+    for s in versions:
+        h.add_version("rec", s)
+    assert [x['version'] for x in h.versions("rec")] == [10, 11, 12]
+    for v in (10, 11, 12):
+        assert h.get_version("rec", v) == versions[v - 1]
+
+
+def test_delete(tmp_path):
+    h = RecordHistory(str(tmp_path))
+    h.add_version("rec", {"a": 1})
+    h.delete("rec")
+    assert h.versions("rec") == []
+    h.add_version("rec", {"a": 2})
+    assert h.versions("rec")[0]['version'] == 1
+
+
+def test_invalid_arguments(tmp_path):
+    with pytest.raises(ValueError):
+        RecordHistory(str(tmp_path), snapshot_interval=0)
+    with pytest.raises(ValueError):
+        RecordHistory(str(tmp_path), max_versions=0)
+    h = RecordHistory(str(tmp_path))
+    with pytest.raises(ValueError):
+        h.compact("rec", 0)
@@ -0,0 +1,167 @@
+from threading import Event, Thread
+
+import pytest
+
+from uchicagoldrhrapi.writebehind import WriteBehindBuffer
+
+
+class Disk(object):
+    # A writer which records what reached "disk", optionally blocking part
+    # way through a write until released
+    def __init__(self):
+        self.files = {}
+        self.writes = []
+        self.fail = None
+        self.block = None
+        self.entered = Event()
+
+    def __call__(self, identifier, obj, fsync):
+        self.entered.set()
+        if self.block is not None:
+            self.block.wait(5)
+        if self.fail is not None:
+            raise self.fail
+        self.files[identifier] = obj
+        self.writes.append((identifier, fsync))
+
+
+@pytest.fixture
+def disk():
+    return Disk()
+
+
+@pytest.fixture
+def buf(disk):
+    # Long enough that the background thread never flushes during a test
+    b = WriteBehindBuffer(disk, 3600)
+    yield b
+    disk.block = None
+    disk.fail = None
+    b.close()
+
+
+def test_interval_must_be_positive(disk):
+    with pytest.raises(ValueError):
+        WriteBehindBuffer(disk, 0)
+
+
+def test_coalesces_writes(buf, disk):
+    for i in range(10):
+        buf.put("a", {"n": i})
+    buf.put("b", {"n": 0})
+    buf.flush()
+    assert disk.files == {"a": {"n": 9}, "b": {"n": 0}}
+    assert sorted(disk.writes) == [("a", False), ("b", False)]
+    assert buf.pending_identifiers() == []
+
+
+def test_put_and_get_copy(buf):
+    r = {"n": [1]}
+    buf.put("a", r)
+    r["n"].append(2)
+    got = buf.get("a")
+    assert got == {"n": [1]}
+    got["n"].append(3)
+    assert buf.get("a") == {"n": [1]}
+    assert buf.get("b") is None
+
+
+def test_read_your_writes_during_flush(buf, disk):
+    buf.put("a", {"n": 1})
+    disk.block = Event()
+    t = Thread(target=buf.flush)
+    t.start()
+    assert disk.entered.wait(5)
+    # Still readable while the write is in progress...
+    assert buf.get("a") == {"n": 1}
+    # ...and a newer write during the flush isn't lost when it finishes
+    buf.put("a", {"n": 2})
+    disk.block.set()
+    t.join(5)
+    assert disk.files["a"] == {"n": 1}
+    assert buf.get("a") == {"n": 2}
+    buf.flush()
+    assert disk.files["a"] == {"n": 2}
+    assert buf.pending_identifiers() == []
+
+
+def test_discard_waits_for_flush(buf, disk):
+    buf.put("a", {"n": 1})
+    disk.block = Event()
+    flusher = Thread(target=buf.flush)
+    flusher.start()
+    assert disk.entered.wait(5)
+    discarded = []
+    discarder = Thread(target=lambda: discarded.append(buf.discard("a")))
+    discarder.start()
+    discarder.join(0.2)
+    # Blocked until the write lands, so whoever is deleting the record
+    # removes the file after it's written rather than before
+    assert discarder.is_alive()
+    disk.block.set()
+    flusher.join(5)
+    discarder.join(5)
+    assert "a" in disk.files
+    # The write finished first, so there was nothing left to discard
+    assert discarded == [False]
+    assert buf.pending_identifiers() == []
+
+
+def test_discard_pending(buf, disk):
+    buf.put("a", {"n": 1})
+    assert buf.discard("a")
+    assert not buf.discard("a")
+    buf.flush()
+    assert disk.files == {}
+
+
+def test_durable_flush_raises(buf, disk):
+    buf.put("a", {"n": 1})
+    disk.fail = OSError("disk full")
+    with pytest.raises(OSError):
+        buf.flush("a", fsync=True)
+    # Nothing is lost, it's retried on the next flush
+    assert buf.get("a") == {"n": 1}
+    disk.fail = None
+    buf.flush("a", fsync=True)
+    assert disk.writes == [("a", True)]
+    assert buf.pending_identifiers() == []
+
+
+def test_background_flush_swallows_errors(buf, disk):
+    buf.put("a", {"n": 1})
+    disk.fail = OSError("disk full")
+    buf.flush()
+    assert buf.get("a") == {"n": 1}
+
+
+def test_flush_single_identifier(buf, disk):
+    buf.put("a", {"n": 1})
+    buf.put("b", {"n": 2})
+    buf.flush("a")
+    buf.flush("missing")
+    assert disk.files == {"a": {"n": 1}}
+    assert buf.pending_identifiers() == ["b"]
+
+
+def test_close_flushes_and_stops(disk):
+    b = WriteBehindBuffer(disk, 3600)
+    b.put("a", {"n": 1})
+    b.close()
+    assert not b._thread.is_alive()
+    assert disk.files == {"a": {"n": 1}}
+    # Safe to call again, eg from atexit after an explicit close
+    b.close()
+
+
+def test_background_thread_flushes(disk):
+    b = WriteBehindBuffer(disk, 0.01)
+    try:
+        b.put("a", {"n": 1})
+        for _ in range(500):
+            if "a" in disk.files:
+                break
+            Event().wait(0.01)
+        assert disk.files == {"a": {"n": 1}}
+    finally:
+        b.close()
@@ -0,0 +1,121 @@
+from re import compile as regex_compile
+
+
+# Conf column names, as they appear in the conf csvs
+FIELD_NAME = "Field Name"
+OBLIGATION = "Obligation"
+CARDINALITY = "Cardinality"
+VALUE_TYPE = "Value Type"
+VALIDATION = "Validation"
+
+_TYPES = {
+    "str": str,
+    "string": str,
+    "int": int,
+    "integer": int,
+    "float": float,
+    "bool": bool,
+    "boolean": bool,
+    "dict": dict,
+    "list": list
+}
+
+
+def _flatten(data):
+    # Walk the record tree once, collecting every value found at each
+    # (index free) key path along with how many values each occurrence held
+    values = {}
+    occurrences = {}
+    stack = [("", data)]
+    while stack:
+        prefix, node = stack.pop()
+        for k, v in node.items():
+            path = prefix + k
+            if isinstance(v, list):
+                members = v
+            else:
+                members = [v]
+            values.setdefault(path, []).extend(members)
+            occurrences.setdefault(path, []).append(len(members))
+            for m in members:
+                if isinstance(m, dict):
+                    stack.append((path + ".", m))
+    return values, occurrences
+
+
+class CompiledRule(object):
+    def __init__(self, rule):
+        self.rule_id = rule.get('id')
+        self.required = str(rule.get(OBLIGATION, "")).strip().lower() in \
+            ("r", "required", "true", "1")
+        self.single = str(rule.get(CARDINALITY, "")).strip().lower() == "1"
+        self.value_type = None
+        type_name = str(rule.get(VALUE_TYPE, "")).strip().lower()
+        if type_name:
+            if type_name not in _TYPES:
+                raise ValueError(
+                    "Unknown value type {} in rule {}".format(type_name,
+                                                              self.rule_id)
+                )
+            self.value_type = _TYPES[type_name]
+        self.pattern = None
+        if rule.get(VALIDATION):
+            self.pattern = regex_compile(rule[VALIDATION])
+
+    def check(self, path, values, occurrences, errors):
+        if not values:
+            if self.required:
+                errors.append("{} is required.".format(path))
+            return
+        if self.single and any(x > 1 for x in occurrences):
+            errors.append("{} may only appear once.".format(path))
+        for v in values:
+            # bool is a subclass of int, so don't let it sneak through
+            if self.value_type is not None and (
+                not isinstance(v, self.value_type) or
+                (self.value_type is int and isinstance(v, bool))
+            ):
+                errors.append(
+                    "{} must be of type {}.".format(path,
+                                                    self.value_type.__name__)
+                )
+            elif self.pattern is not None and not isinstance(v, dict) and \
+                    not self.pattern.match(str(v)):
+                errors.append(
+                    "{} value {} does not match {}.".format(
+                        path, v, self.pattern.pattern
+                    )
+                )
+
+
+class CompiledRecordValidator(object):
+    # Evaluation plan for a RecordConf. Rules are compiled once and grouped
+    # by key path, so validating a record walks the record a single time
+    # regardless of how many rules the conf has.
+    def __init__(self, conf):
+        self._plan = []
+        by_path = {}
+        for rule in conf.data:
+            path = rule[FIELD_NAME]
+            if path not in by_path:
+                by_path[path] = []
+                self._plan.append((path, by_path[path]))
+            by_path[path].append(CompiledRule(rule))
+        self._parents = {}
+        for path, _ in self._plan:
+            if "." in path:
+                self._parents[path] = path.rsplit(".", 1)[0]
+
+    def validate(self, record):
+        values, occurrences = _flatten(record.data)
+        errors = []
+        for path, rules in self._plan:
+            parent = self._parents.get(path)
+            # Obligations on nested keys only apply where the parent exists
+            if parent is not None and parent not in values and \
+                    path not in values:
+                continue
+            for rule in rules:
+                rule.check(path, values.get(path, []),
+                           occurrences.get(path, []), errors)
+        return (len(errors) == 0, errors)
@@ -0,0 +1,101 @@
+from zlib import compressobj, DEFLATED, MAX_WBITS, Z_SYNC_FLUSH
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Content-Encoding negotiation for responses. gzip is always available,
+# zstd only when the zstandard package is installed.
+
+def available_encodings():
+    if zstandard is not None:
+        return ["zstd", "gzip"]
+    return ["gzip"]
+
+
+def choose_encoding(accept_encodings):
+    # accept_encodings is a werkzeug Accept, eg request.accept_encodings.
+    # Ties go to whichever encoding comes first in available_encodings().
+    best = None
+    best_quality = 0
+    for x in available_encodings():
+        q = accept_encodings.quality(x)
+        if q > best_quality:
+            best = x
+            best_quality = q
+    return best
+
+
+class _Compressor(object):
+    def __init__(self, encoding, level):
+        if encoding == "gzip":
+            # +16 for a gzip header rather than a zlib one
+            self._c = compressobj(level, DEFLATED, MAX_WBITS | 16)
+            self._flush_mode = Z_SYNC_FLUSH
+        elif encoding == "zstd":
+            self._c = zstandard.ZstdCompressor(level=level).compressobj()
+            self._flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            raise ValueError("Unsupported encoding: {}".format(encoding))
+
+    def compress(self, data):
+        return self._c.compress(data)
+
+    def flush(self):
+        # Emit everything compressed so far without ending the stream
+        return self._c.flush(self._flush_mode)
+
+    def finish(self):
+        return self._c.flush()
+
+
+def compress(data, encoding, level):
+    c = _Compressor(encoding, level)
+    return c.compress(data) + c.finish()
+
+
+def compress_stream(chunks, encoding, level):
+    c = _Compressor(encoding, level)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        if not chunk:
+            continue
+        # Flush every chunk, otherwise the compressor holds on to them and
+        # nothing reaches the client until the stream ends
+        yield c.compress(chunk) + c.flush()
+    yield c.finish()
+
+
+def compress_response(response, accept_encodings, min_size=1024, levels=None):
+    # Compresses a flask Response in place, if the client accepts one of
+    # our encodings and it's worth doing
+    if levels is None:
+        levels = {}
+    response.vary.add("Accept-Encoding")
+    if response.status_code < 200 or \
+            response.status_code in (204, 206, 304) or \
+            "Content-Encoding" in response.headers or \
+            "Content-Range" in response.headers:
+        # Nothing to compress, the body is already encoded (eg stored
+        # compressed bytes being passed through as they are), or it's only
+        # part of the body, which can't be compressed on its own
+        return response
+    encoding = choose_encoding(accept_encodings)
+    if encoding is None:
+        return response
+    level = levels.get(encoding, 6 if encoding == "gzip" else 3)
+    if response.is_streamed:
+        # We can't know the size up front, so streams are always compressed
+        response.response = compress_stream(response.response, encoding,
+                                             level)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compress(data, encoding, level))
+    response.headers["Content-Encoding"] = encoding
+    return response
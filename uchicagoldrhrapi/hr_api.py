@@ -1,8 +1,12 @@
-from flask import jsonify, Blueprint
-from flask_restful import Resource, Api, reqparse
+from flask import Blueprint, Response, request
+from flask_restful import Resource, Api, reqparse, inputs
 from uuid import uuid1
-from os import scandir, remove
+from os import scandir, remove, stat, fsync, makedirs, replace, close, \
+    open as os_open, O_RDONLY
 from os.path import join
+from json import dumps
+from time import time
+from threading import Lock
 from werkzeug.utils import secure_filename
 from re import compile as regex_compile
 
@@ -14,6 +18,13 @@ from hierarchicalrecord.hierarchicalrecord import HierarchicalRecord
 from hierarchicalrecord.recordconf import RecordConf
 from hierarchicalrecord.recordvalidator import RecordValidator
 
+from .compiledvalidator import CompiledRecordValidator
+from .writebehind import WriteBehindBuffer
+from .recordhistory import RecordHistory
+from .jobs import JobQueue
+from .jsoncodec import codec as json_codec, FastJSONModule
+from .compression import compress_response
+
 
 # Globals
 _ALPHANUM_PATTERN = regex_compile("^[a-zA-Z0-9]+$")
@@ -21,6 +32,37 @@ _NUMERIC_PATTERN = regex_compile("^[0-9]+$")
 _EXCEPTION_HANDLER = APIExceptionHandler()
 
 _STORAGE_ROOT = app.config['STORAGE_ROOT']
+# Scratch space for atomic writes, on the same filesystem as the records
+makedirs(join(_STORAGE_ROOT, 'tmp'), exist_ok=True)
+# Anything left in there for over an hour is from a write that crashed,
+# rather than one another process is in the middle of
+for _x in scandir(join(_STORAGE_ROOT, 'tmp')):
+    try:
+        if _x.is_file() and _x.stat().st_mtime < time() - 3600:
+            remove(_x.path)
+    except FileNotFoundError:
+        pass
+_COMPILED_VALIDATORS = app.config.get('COMPILED_VALIDATORS', False)
+
+# Encode responses and decode request bodies with orjson, when enabled
+# and available
+_FAST_JSON = app.config.get('FAST_JSON', False)
+_JSON_DUMPS = json_codec(_FAST_JSON)[0]
+
+# conf_id -> ((conf mtime, conf size), compiled validator)
+_VALIDATOR_CACHE = {}
+_VALIDATOR_CACHE_LOCK = Lock()
+
+# Coalesces record writes in memory when WRITE_BEHIND_INTERVAL is set
+_WRITE_BUFFER = None
+
+_HISTORY = None
+if app.config.get('RECORD_HISTORY', False):
+    _HISTORY = RecordHistory(
+        join(_STORAGE_ROOT, 'history'),
+        snapshot_interval=app.config.get('HISTORY_SNAPSHOT_INTERVAL', 10),
+        max_versions=app.config.get('HISTORY_MAX_VERSIONS')
+    )
 
 
 # Most of these are abstracted because they should be hooked
@@ -41,6 +83,10 @@ def retrieve_record(identifier):
     identifier = secure_filename(identifier)
     if not only_alphanumeric(identifier):
         raise ValueError("Record identifiers must be alphanumeric.")
+    if _WRITE_BUFFER is not None:
+        r = _WRITE_BUFFER.get(identifier)
+        if r is not None:
+            return r
     r = HierarchicalRecord(
         from_file=join(
             _STORAGE_ROOT, 'records', identifier
@@ -49,14 +95,45 @@ def retrieve_record(identifier):
     return r
 
 
-def write_record(record, identifier):
+def _write_record_file(identifier, record, sync):
+    # Write to scratch space and swap it in, so readers never see a
+    # truncated file
+    tmp = join(_STORAGE_ROOT, 'tmp', identifier+"."+uuid1().hex)
+    with open(tmp, 'w') as f:
+        f.write(record.toJSON())
+        if sync:
+            f.flush()
+            fsync(f.fileno())
+    replace(tmp, join(_STORAGE_ROOT, 'records', identifier))
+    if sync:
+        # The rename isn't durable until the directory entry is
+        fd = os_open(join(_STORAGE_ROOT, 'records'), O_RDONLY)
+        try:
+            fsync(fd)
+        finally:
+            close(fd)
+    if _HISTORY is not None:
+        # The record is already safely written, so a history failure mustn't
+        # fail the write (or have write behind retry it, duplicating the
+        # version) - losing one version is the lesser evil
+        try:
+            _HISTORY.add_version(identifier, record.data)
+        except Exception:
+            app.logger.exception(
+                "Couldn't add a history version of record %s", identifier
+            )
+
+
+def write_record(record, identifier, durable=False):
     identifier = secure_filename(identifier)
     if not only_alphanumeric(identifier):
         raise ValueError("Record identifiers must be alphanumeric.")
-    with open(
-        join(_STORAGE_ROOT, 'records', identifier), 'w'
-    ) as f:
-        f.write(record.toJSON())
+    if _WRITE_BUFFER is None:
+        _write_record_file(identifier, record, durable)
+    else:
+        _WRITE_BUFFER.put(identifier, record)
+        if durable:
+            _WRITE_BUFFER.flush(identifier, fsync=True)
 
 
 def delete_record(identifier):
@@ -64,7 +141,17 @@ def delete_record(identifier):
     if not only_alphanumeric(identifier):
         raise ValueError("Record identifiers must be alphanumeric.")
     rec_path = join(_STORAGE_ROOT, 'records', identifier)
-    remove(rec_path)
+    # Drop any buffered write first, so a flush can't write the record (and
+    # its history) back after we've deleted them
+    discarded = _WRITE_BUFFER is not None and _WRITE_BUFFER.discard(identifier)
+    try:
+        remove(rec_path)
+    except FileNotFoundError:
+        # The record may never have reached the disk
+        if not discarded:
+            raise
+    if _HISTORY is not None:
+        _HISTORY.delete(identifier)
 
 
 def retrieve_conf(conf_str):
@@ -84,6 +171,8 @@ def write_conf(conf, conf_id):
         raise ValueError("Conf identifiers must be alphanumeric.")
     path = join(_STORAGE_ROOT, 'confs', conf_id+".csv")
     conf.to_csv(path)
+    with _VALIDATOR_CACHE_LOCK:
+        _VALIDATOR_CACHE.pop(conf_id, None)
 
 
 def delete_conf(identifier):
@@ -92,6 +181,8 @@ def delete_conf(identifier):
         raise ValueError("Conf identifiers must be alphanumeric.")
     rec_path = join(_STORAGE_ROOT, 'confs', identifier+".csv")
     remove(rec_path)
+    with _VALIDATOR_CACHE_LOCK:
+        _VALIDATOR_CACHE.pop(identifier, None)
 
 
 def retrieve_category(category):
@@ -128,13 +219,57 @@ def delete_category(identifier):
     remove(rec_path)
 
 
+def retrieve_history():
+    if _HISTORY is None:
+        raise ValueError("Record history is not enabled.")
+    return _HISTORY
+
+
+def read_category_members(identifier):
+    # Unlike retrieve_category, this doesn't insist every member still
+    # exists, so it works on categories with dangling members
+    identifier = secure_filename(identifier)
+    if not only_alphanumeric(identifier):
+        raise ValueError("Categories must be alphanumeric.")
+    with open(join(_STORAGE_ROOT, 'org', identifier), 'r') as f:
+        return [x.rstrip('\n') for x in f.readlines() if x.rstrip('\n')]
+
+
+def remove_category_members(identifier, record_ids):
+    members = read_category_members(identifier)
+    kept = [x for x in members if x not in record_ids]
+    if len(kept) != len(members):
+        with open(join(_STORAGE_ROOT, 'org', identifier), 'w') as f:
+            for x in kept:
+                f.write(x+'\n')
+
+
 def build_validator(conf):
+    if _COMPILED_VALIDATORS:
+        return CompiledRecordValidator(conf)
     return RecordValidator(conf)
 
 
 def retrieve_validator(conf_id):
-    c = retrieve_conf(conf_id)
-    return build_validator(c)
+    if not _COMPILED_VALIDATORS:
+        c = retrieve_conf(conf_id)
+        return build_validator(c)
+    conf_id = secure_filename(conf_id)
+    if not only_alphanumeric(conf_id):
+        raise ValueError("Conf identifiers must be alphanumeric.")
+    # Compiling is the expensive part, so only do it when the conf changes.
+    # write_conf drops the entry too, since two rewrites can land within
+    # one mtime tick.
+    st = stat(join(_STORAGE_ROOT, 'confs', conf_id+".csv"))
+    version = (st.st_mtime_ns, st.st_size)
+    with _VALIDATOR_CACHE_LOCK:
+        cached = _VALIDATOR_CACHE.get(conf_id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    v = build_validator(retrieve_conf(conf_id))
+    with _VALIDATOR_CACHE_LOCK:
+        _VALIDATOR_CACHE[conf_id] = (version, v)
+    return v
 
 
 def get_categories():
@@ -148,6 +283,13 @@ def get_categories():
 
 
 def get_existing_record_identifiers():
+    if _WRITE_BUFFER is not None:
+        on_disk = set(x.name for x in scandir(
+            join(
+                _STORAGE_ROOT, 'records'
+            )) if x.is_file())
+        pending = _WRITE_BUFFER.pending_identifiers()
+        return iter(list(on_disk) + [x for x in pending if x not in on_disk])
     return (x.name for x in scandir(
         join(
             _STORAGE_ROOT, 'records'
@@ -169,13 +311,13 @@ def get_existing_categories():
 
 
 def parse_value(value):
-    if value is "True":
+    if value == "True":
         return True
-    elif value is "False":
+    elif value == "False":
         return False
-    elif value is "{}":
+    elif value == "{}":
         return {}
-    elif value is "[]":
+    elif value == "[]":
         return []
     elif _NUMERIC_PATTERN.match(value):
         return int(value)
@@ -183,6 +325,11 @@ def parse_value(value):
         return value
 
 
+def respond(r):
+    # Encode the envelope straight to the response body, skipping jsonify
+    return Response(_JSON_DUMPS(r.dictify()), mimetype="application/json")
+
+
 class RecordCategory(object):
     def __init__(self, title):
         self._title = None
@@ -231,6 +378,53 @@ class RecordCategory(object):
     records = property(get_records, set_records, del_records)
 
 
+# Request schemas, built once rather than on every request
+_NEW_RECORD_PARSER = reqparse.RequestParser()
+_NEW_RECORD_PARSER.add_argument('record', type=dict)
+_NEW_RECORD_PARSER.add_argument('conf_identifier', type=str)
+_NEW_RECORD_PARSER.add_argument('durable', type=inputs.boolean, default=False)
+
+_RECORD_VERSION_PARSER = reqparse.RequestParser()
+_RECORD_VERSION_PARSER.add_argument('version', type=int, location='args')
+
+_RECORD_PUT_PARSER = reqparse.RequestParser()
+_RECORD_PUT_PARSER.add_argument('record', type=dict, required=True)
+_RECORD_PUT_PARSER.add_argument('conf_identifier', type=str)
+_RECORD_PUT_PARSER.add_argument('durable', type=inputs.boolean, default=False)
+
+_COMPACT_HISTORY_PARSER = reqparse.RequestParser()
+_COMPACT_HISTORY_PARSER.add_argument('keep', type=int, required=True)
+
+_SET_ENTRY_PARSER = reqparse.RequestParser()
+_SET_ENTRY_PARSER.add_argument('value', required=True)
+_SET_ENTRY_PARSER.add_argument('conf_identifier', type=str)
+_SET_ENTRY_PARSER.add_argument('durable', type=inputs.boolean, default=False)
+
+_DELETE_ENTRY_PARSER = reqparse.RequestParser()
+_DELETE_ENTRY_PARSER.add_argument('conf_identifier', type=str)
+_DELETE_ENTRY_PARSER.add_argument('durable', type=inputs.boolean, default=False)
+
+_VALIDATION_PARSER = reqparse.RequestParser()
+_VALIDATION_PARSER.add_argument('record_identifier', type=str, required=True)
+_VALIDATION_PARSER.add_argument('conf_identifier', type=str, required=True)
+
+_NEW_RULE_PARSER = reqparse.RequestParser()
+_NEW_RULE_PARSER.add_argument('rule', type=dict, required=True)
+
+_RULE_COMPONENT_PARSER = reqparse.RequestParser()
+_RULE_COMPONENT_PARSER.add_argument('component_value', type=str, required=True)
+
+_NEW_CATEGORY_PARSER = reqparse.RequestParser()
+_NEW_CATEGORY_PARSER.add_argument('category_identifier', type=str, required=True)
+
+_CATEGORY_MEMBER_PARSER = reqparse.RequestParser()
+_CATEGORY_MEMBER_PARSER.add_argument('record_identifier', type=str, required=True)
+
+_NEW_JOB_PARSER = reqparse.RequestParser()
+_NEW_JOB_PARSER.add_argument('kind', type=str, required=True)
+_NEW_JOB_PARSER.add_argument('params', type=dict)
+
+
 class RecordsRoot(Resource):
     def get(self):
         # List all records
@@ -240,17 +434,14 @@ class RecordsRoot(Resource):
                 data={"record_identifiers": [x for x in
                                              get_existing_record_identifiers()]}
             )
-            return jsonify(r.dictify())
+            return respond(r)
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
     def post(self):
         # New Record
         try:
-            parser = reqparse.RequestParser()
-            parser.add_argument('record', type=dict)
-            parser.add_argument('conf_identifier', type=str)
-            args = parser.parse_args()
+            args = _NEW_RECORD_PARSER.parse_args()
             identifier = uuid1().hex
             r = HierarchicalRecord()
             if args['record']:
@@ -259,54 +450,63 @@ class RecordsRoot(Resource):
                 validator = retrieve_validator(args['conf_identifier'])
                 validity = validator.validate(r)
                 if not validity[0]:
-                    return jsonify(
-                        APIResponse("fail", errors=validity[1]).dictify()
+                    return respond(
+                        APIResponse("fail", errors=validity[1])
                     )
-            write_record(r, identifier)
+            write_record(r, identifier, durable=args['durable'])
             resp = APIResponse("success",
                                data={"record_identifier": identifier,
                                      "record": r.data})
-            return jsonify(resp.dictify())
+            return respond(resp)
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
 
 class RecordRoot(Resource):
     def get(self, identifier):
-        # Get the whole record
+        # Get the whole record, or an earlier version of it
         try:
+            args = _RECORD_VERSION_PARSER.parse_args()
+            if args['version'] is not None:
+                identifier = secure_filename(identifier)
+                if not only_alphanumeric(identifier):
+                    raise ValueError("Record identifiers must be alphanumeric.")
+                data = retrieve_history().get_version(identifier,
+                                                      args['version'])
+                resp = APIResponse("success",
+                                   data={"record": data,
+                                         "record_identifier": identifier,
+                                         "version": args['version']})
+                return respond(resp)
             r = retrieve_record(identifier)
             resp = APIResponse("success",
                                data={"record": r.data,
                                      "record_identifier": identifier})
-            return jsonify(resp.dictify())
+            return respond(resp)
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
     def put(self, identifier):
         # overwrite a whole record
         try:
-            parser = reqparse.RequestParser()
-            parser.add_argument('record', type=dict, required=True)
-            parser.add_argument('conf_identifier', type=str)
-            args = parser.parse_args()
+            args = _RECORD_PUT_PARSER.parse_args()
             record = retrieve_record(identifier)
             record.data = args.record
             if args['conf_identifier']:
                 validator = retrieve_validator(args['conf_identifier'])
                 validity = validator.validate(record)
                 if not validity[0]:
-                    return jsonify(
-                        APIResponse("fail", errors=validity[1]).dictify()
+                    return respond(
+                        APIResponse("fail", errors=validity[1])
                     )
-            write_record(record, identifier)
-            return jsonify(
+            write_record(record, identifier, durable=args['durable'])
+            return respond(
                 APIResponse("success",
                             data={'record_identifier': identifier,
-                                  'record': record.data}).dictify()
+                                  'record': record.data})
             )
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
     def delete(self, identifier):
         # delete a record
@@ -317,9 +517,45 @@ class RecordRoot(Resource):
                 data={"records": [x for x in get_existing_record_identifiers()],
                       "deleted_identifier": identifier}
             )
-            return jsonify(r.dictify())
+            return respond(r)
+        except Exception as e:
+            return respond(_EXCEPTION_HANDLER.handle(e))
+
+
+class RecordVersions(Resource):
+    def get(self, identifier):
+        # list the stored versions of a record
+        try:
+            identifier = secure_filename(identifier)
+            if not only_alphanumeric(identifier):
+                raise ValueError("Record identifiers must be alphanumeric.")
+            return respond(
+                APIResponse("success",
+                            data={"record_identifier": identifier,
+                                  "versions": retrieve_history().versions(
+                                      identifier
+                                  )})
+            )
+        except Exception as e:
+            return respond(_EXCEPTION_HANDLER.handle(e))
+
+    def delete(self, identifier):
+        # compact the history, keeping only the newest versions
+        try:
+            args = _COMPACT_HISTORY_PARSER.parse_args()
+            identifier = secure_filename(identifier)
+            if not only_alphanumeric(identifier):
+                raise ValueError("Record identifiers must be alphanumeric.")
+            h = retrieve_history()
+            dropped = h.compact(identifier, args['keep'])
+            return respond(
+                APIResponse("success",
+                            data={"record_identifier": identifier,
+                                  "dropped_versions": dropped,
+                                  "versions": h.versions(identifier)})
+            )
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
 
 class EntryRoot(Resource):
@@ -328,23 +564,20 @@ class EntryRoot(Resource):
         try:
             r = retrieve_record(identifier)
             v = r[key]
-            return jsonify(
+            return respond(
                 APIResponse(
                     "success",
                     data={'record_identifier': identifier,
                           'key': key, 'value': v}
-                ).dictify()
+                )
             )
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
     def post(self, identifier, key):
         # Set a value
         try:
-            parser = reqparse.RequestParser()
-            parser.add_argument('value', required=True)
-            parser.add_argument('conf_identifier', type=str)
-            args = parser.parse_args()
+            args = _SET_ENTRY_PARSER.parse_args()
             v = parse_value(args['value'])
             r = retrieve_record(identifier)
             r[key] = v
@@ -352,50 +585,45 @@ class EntryRoot(Resource):
                 validator = retrieve_validator(args['conf_identifier'])
                 validity = validator.validate(r)
                 if not validity[0]:
-                    return jsonify(
-                        APIResponse("fail", errors=validity[1]).dictify()
+                    return respond(
+                        APIResponse("fail", errors=validity[1])
                     )
-            write_record(r, identifier)
-            return jsonify(
+            write_record(r, identifier, durable=args['durable'])
+            return respond(
                 APIResponse("success",
                             data={'record': r.data,
-                                  'record_identifier': identifier}).dictify()
+                                  'record_identifier': identifier})
             )
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
     def delete(self, identifier, key):
         # delete a value
         try:
-            parser = reqparse.RequestParser()
-            parser.add_argument('conf_identifier', type=str)
-            args = parser.parse_args()
+            args = _DELETE_ENTRY_PARSER.parse_args()
             r = retrieve_record(identifier)
             del r[key]
             if args['conf_identifier']:
                 validator = retrieve_validator(args['conf_identifier'])
                 validity = validator.validate(r)
                 if not validity[0]:
-                    return jsonify(
-                        APIResponse("fail", errors=validity[1]).dictify()
+                    return respond(
+                        APIResponse("fail", errors=validity[1])
                     )
-            write_record(r, identifier)
-            return jsonify(
+            write_record(r, identifier, durable=args['durable'])
+            return respond(
                 APIResponse("success",
                             data={'record': r.data,
-                                  'record_identifier': identifier}).dictify()
+                                  'record_identifier': identifier})
             )
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
 
 class ValidationRoot(Resource):
     def post(self):
         try:
-            parser = reqparse.RequestParser()
-            parser.add_argument('record_identifier', type=str, required=True)
-            parser.add_argument('conf_identifier', type=str, required=True)
-            args = parser.parse_args(strict=True)
+            args = _VALIDATION_PARSER.parse_args(strict=True)
 
             v = retrieve_validator(args['conf_identifier'])
             r = retrieve_record(args['record_identifier'])
@@ -409,9 +637,9 @@ class ValidationRoot(Resource):
                                    "record": r.data
                                    }
                                )
-            return jsonify(resp.dictify())
+            return respond(resp)
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
 
 class ConfsRoot(Resource):
@@ -423,9 +651,9 @@ class ConfsRoot(Resource):
                 data={"conf_identifiers": [x for x in
                                            get_existing_conf_identifiers()]}
             )
-            return jsonify(r.dictify())
+            return respond(r)
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
     def post(self):
         # New Conf
@@ -438,9 +666,9 @@ class ConfsRoot(Resource):
                 data={"conf_identifier": new_conf_identifier,
                       "conf": c.data}
             )
-            return jsonify(r.dictify())
+            return respond(r)
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
 
 class ConfRoot(Resource):
@@ -448,33 +676,31 @@ class ConfRoot(Resource):
         # return a specific conf
         try:
             c = retrieve_conf(identifier)
-            return jsonify(
+            return respond(
                 APIResponse("success",
                             data={"conf_identifier": identifier,
                                   "conf": c.data}
-                            ).dictify()
+                            )
             )
 
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
     def post(self, identifier):
         # set validation rule
         try:
-            parser = reqparse.RequestParser()
-            parser.add_argument('rule', type=dict, required=True)
-            args = parser.parse_args()
+            args = _NEW_RULE_PARSER.parse_args()
             c = retrieve_conf(identifier)
             c.add_rule(args['rule'])
             write_conf(c, identifier)
-            return jsonify(
+            return respond(
                 APIResponse("success",
                             data={"conf_identifier": identifier,
                                   "conf": c.data}
-                            ).dictify()
+                            )
             )
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
     def delete(self, identifier):
         # Delete this conf
@@ -486,9 +712,9 @@ class ConfRoot(Resource):
                                            get_existing_conf_identifiers()],
                       "deleted_conf_identifier": identifier}
             )
-            return jsonify(r.dictify())
+            return respond(r)
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
 
 class RulesRoot(Resource):
@@ -510,9 +736,9 @@ class RulesRoot(Resource):
                 data={"conf_identifier": identifier,
                       "rule": rule}
             )
-            return jsonify(r.dictify())
+            return respond(r)
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
     def delete(self, identifier, rule_id):
         # delete a rule
@@ -520,12 +746,12 @@ class RulesRoot(Resource):
             c = retrieve_conf(identifier)
             c.data = [x for x in c.data if x['id'] != rule_id]
             write_conf(c, identifier)
-            return jsonify(
+            return respond(
                 APIResponse("success", data={"conf_identifier": identifier,
-                                             "conf": c.data}).dictify()
+                                             "conf": c.data})
             )
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
 
 class RuleComponentRoot(Resource):
@@ -549,14 +775,14 @@ class RuleComponentRoot(Resource):
                                                                          rule_id,
                                                                          identifier)
                 )
-            return jsonify(
+            return respond(
                 APIResponse("success", data={"conf_identifier": identifier,
                                              "rule_id": rule_id,
                                              "component": component,
-                                             "value": value}).dictify()
+                                             "value": value})
             )
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
     def delete(self, identifier, rule_id, component):
         # remove a rule component
@@ -580,22 +806,20 @@ class RuleComponentRoot(Resource):
                                                                          identifier)
                 )
             write_conf(c, identifier)
-            return jsonify(
+            return respond(
                 APIResponse("success", data={"conf_identifier": identifier,
                                              "rule_id": rule_id,
                                              "component": component,
-                                             "value": value}).dictify()
+                                             "value": value})
             )
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
         pass
 
     def post(self, identifier, rule_id, component):
         # Add a rule component to this rule
         try:
-            parser = reqparse.RequestParser()
-            parser.add_argument('component_value', type=str, required=True)
-            args = parser.parse_args()
+            args = _RULE_COMPONENT_PARSER.parse_args()
 
             c = retrieve_conf(identifier)
             rule = None
@@ -616,14 +840,14 @@ class RuleComponentRoot(Resource):
                                                                          identifier)
                 )
             write_conf(c, identifier)
-            return jsonify(
+            return respond(
                 APIResponse("success", data={"conf_identifier": identifier,
                                              "rule_id": rule_id,
                                              "component": component,
-                                             "value": value}).dictify()
+                                             "value": value})
             )
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
 
 class CategoriesRoot(Resource):
@@ -635,16 +859,14 @@ class CategoriesRoot(Resource):
                 data={"category_identifiers": [x for x in
                                                get_existing_categories()]}
             )
-            return jsonify(r.dictify())
+            return respond(r)
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
     def post(self):
         # Add a category
         try:
-            parser = reqparse.RequestParser()
-            parser.add_argument('category_identifier', type=str, required=True)
-            args = parser.parse_args()
+            args = _NEW_CATEGORY_PARSER.parse_args()
 
             if not only_alphanumeric(args['category_identifier']):
                 raise ValueError(
@@ -662,16 +884,16 @@ class CategoriesRoot(Resource):
 
             c = retrieve_category(args['category_identifier'])
             write_category(c, args['category_identifier'])
-            return jsonify(
+            return respond(
                 APIResponse(
                     "success",
                     data={"category_identifier": args['category_identifier'],
                           "record_identifiers": c.records}
-                ).dictify()
+                )
             )
 
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
 
 class CategoryRoot(Resource):
@@ -679,31 +901,29 @@ class CategoryRoot(Resource):
         # list all records in this category
         try:
             c = retrieve_category(cat_identifier)
-            return jsonify(
+            return respond(
                 APIResponse("success",
                             data={"category_identifier": cat_identifier,
-                                  "record_identifiers": c.records}).dictify()
+                                  "record_identifiers": c.records})
             )
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
     def post(self, cat_identifier):
         # Add a record to this category
         try:
-            parser = reqparse.RequestParser()
-            parser.add_argument('record_identifier', type=str, required=True)
-            args = parser.parse_args()
+            args = _CATEGORY_MEMBER_PARSER.parse_args()
 
             c = retrieve_category(cat_identifier)
             c.add_record(args['record_identifier'])
             write_category(c, cat_identifier)
-            return jsonify(
+            return respond(
                 APIResponse("success",
                             data={"category_identifier": cat_identifier,
-                                  "record_identifiers": c.records}).dictify()
+                                  "record_identifiers": c.records})
             )
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
     def delete(self, cat_identifier):
         # delete this category
@@ -714,9 +934,9 @@ class CategoryRoot(Resource):
                 data={"category_identifiers": [x for x in
                                                get_existing_categories()]}
             )
-            return jsonify(r.dictify())
+            return respond(r)
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
 
 class CategoryMember(Resource):
@@ -725,11 +945,11 @@ class CategoryMember(Resource):
         try:
             c = retrieve_category(cat_identifier)
             if rec_identifier in c.records:
-                return jsonify(
+                return respond(
                     APIResponse("success",
                                 data={"category_identifier": cat_identifier,
                                       "record_identifiers": c.records,
-                                      "record_present": True}).dictify()
+                                      "record_present": True})
                 )
             else:
                 raise ValueError(
@@ -737,7 +957,7 @@ class CategoryMember(Resource):
                                                                                cat_identifier)
                 )
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
     def delete(self, cat_identifier, rec_identifier):
         # remove this member from the category
@@ -745,23 +965,191 @@ class CategoryMember(Resource):
             c = retrieve_category(cat_identifier)
             c.records = [x for x in c.records if x != rec_identifier]
             write_category(c, cat_identifier)
-            return jsonify(
+            return respond(
                 APIResponse("success",
                             data={"category_identifier": cat_identifier,
-                                  "record_identifiers": c.records}).dictify()
+                                  "record_identifiers": c.records})
             )
         except Exception as e:
-            return jsonify(_EXCEPTION_HANDLER.handle(e).dictify())
+            return respond(_EXCEPTION_HANDLER.handle(e))
+
+
+# Opt in to coalescing record writes
+if app.config.get('WRITE_BEHIND_INTERVAL'):
+    _WRITE_BUFFER = WriteBehindBuffer(_write_record_file,
+                                      app.config['WRITE_BEHIND_INTERVAL'])
+
+# Long running operations, run by the job queue rather than in a request
+
+def validate_records_job(job, conf_identifier, category_identifier=None):
+    validator = retrieve_validator(conf_identifier)
+    if category_identifier is not None:
+        # Members may be listed more than once
+        identifiers = list(dict.fromkeys(
+            read_category_members(category_identifier)
+        ))
+    else:
+        identifiers = list(get_existing_record_identifiers())
+    invalid = {}
+    missing = []
+    for i, x in enumerate(identifiers):
+        job.progress(i, len(identifiers))
+        try:
+            record = retrieve_record(x)
+        except FileNotFoundError:
+            # A dangling category member, or deleted since we started
+            missing.append(x)
+            continue
+        validity = validator.validate(record)
+        if not validity[0]:
+            invalid[x] = validity[1]
+    job.progress(len(identifiers), len(identifiers))
+    return {"conf_identifier": conf_identifier,
+            "record_count": len(identifiers),
+            "invalid_records": invalid,
+            "missing_records": missing}
+
+
+def export_records_job(job):
+    # One record per line, written to STORAGE_ROOT/exports/<job id>.jsonl
+    identifiers = list(get_existing_record_identifiers())
+    makedirs(join(_STORAGE_ROOT, 'exports'), exist_ok=True)
+    export_name = job.identifier + ".jsonl"
+    with open(join(_STORAGE_ROOT, 'exports', export_name), 'w') as f:
+        for i, x in enumerate(identifiers):
+            job.progress(i, len(identifiers))
+            f.write(dumps({"record_identifier": x,
+                           "record": retrieve_record(x).data}) + '\n')
+    job.progress(len(identifiers), len(identifiers))
+    return {"record_count": len(identifiers), "export": export_name}
+
+
+def delete_category_job(job, category_identifier, delete_records=False):
+    identifiers = read_category_members(category_identifier)
+    deleted = []
+    if delete_records:
+        try:
+            for i, x in enumerate(identifiers):
+                job.progress(i, len(identifiers))
+                try:
+                    delete_record(x)
+                except FileNotFoundError:
+                    # Already gone, only the membership was left behind
+                    pass
+                deleted.append(x)
+        finally:
+            # Even if we're cancelled part way, don't leave what we did
+            # delete behind in any category (this one included)
+            gone = set(deleted)
+            if gone:
+                for c in get_existing_categories():
+                    remove_category_members(c, gone)
+    delete_category(category_identifier)
+    return {"deleted_category_identifier": category_identifier,
+            "deleted_record_identifiers": deleted}
+
+
+_JOBS = None
+if app.config.get('JOB_WORKERS'):
+    _JOBS = JobQueue(join(_STORAGE_ROOT, 'jobs'),
+                     workers=app.config['JOB_WORKERS'],
+                     retention=app.config.get('JOB_RETENTION', 7*24*60*60))
+    _JOBS.register("validate", validate_records_job)
+    _JOBS.register("export", export_records_job)
+    _JOBS.register("delete_category", delete_category_job)
+    _JOBS.resume()
+
+
+def job_identifier(identifier):
+    identifier = secure_filename(identifier)
+    if not only_alphanumeric(identifier):
+        raise ValueError("Job identifiers must be alphanumeric.")
+    return identifier
+
+
+class JobsRoot(Resource):
+    def get(self):
+        # list all jobs
+        try:
+            return respond(
+                APIResponse("success",
+                            data={"job_identifiers": _JOBS.list(),
+                                  "job_kinds": _JOBS.kinds()})
+            )
+        except Exception as e:
+            return respond(_EXCEPTION_HANDLER.handle(e))
+
+    def post(self):
+        # submit a job
+        try:
+            args = _NEW_JOB_PARSER.parse_args()
+            job = _JOBS.submit(args['kind'], args['params'])
+            return respond(
+                APIResponse("success", data={"job": job})
+            )
+        except Exception as e:
+            return respond(_EXCEPTION_HANDLER.handle(e))
+
+
+class JobRoot(Resource):
+    def get(self, job_id):
+        # job status, progress and result
+        try:
+            return respond(
+                APIResponse("success",
+                            data={"job": _JOBS.get(job_identifier(job_id))}
+                            )
+            )
+        except Exception as e:
+            return respond(_EXCEPTION_HANDLER.handle(e))
+
+    def delete(self, job_id):
+        # cancel a job
+        try:
+            job = _JOBS.cancel(job_identifier(job_id))
+            return respond(
+                APIResponse("success",
+                            data={"job": job,
+                                  "cancel_requested": True})
+            )
+        except Exception as e:
+            return respond(_EXCEPTION_HANDLER.handle(e))
 
 
 # Create our app, hook the API to it, and add our resources
 bp = Blueprint("hierarchicalrecordsapi", __name__)
 
+
+@bp.before_request
+def decode_json():
+    # Have request.get_json() (and so reqparse) decode bodies with the fast
+    # codec. Unlike swapping out app.json, this only affects this API's
+    # requests.
+    if _FAST_JSON:
+        request.json_module = FastJSONModule
+
+
+@bp.after_request
+def compress_responses(response):
+    if not app.config.get('COMPRESSION', True):
+        return response
+    return compress_response(
+        response,
+        request.accept_encodings,
+        min_size=app.config.get('COMPRESSION_MIN_SIZE', 1024),
+        levels={"gzip": app.config.get('COMPRESSION_GZIP_LEVEL', 6),
+                "zstd": app.config.get('COMPRESSION_ZSTD_LEVEL', 3)}
+    )
+
+
 api = Api(bp)
 
 # Record manipulation endpoints
 api.add_resource(RecordsRoot, '/record')
 api.add_resource(RecordRoot, '/record/<string:identifier>')
+if _HISTORY is not None:
+    # Only shadow record fields named "versions" when there's history to show
+    api.add_resource(RecordVersions, '/record/<string:identifier>/versions')
 api.add_resource(EntryRoot, '/record/<string:identifier>/<string:key>')
 
 # Validation endpoint
@@ -777,3 +1165,8 @@ api.add_resource(RuleComponentRoot, '/conf/<string:identifier>/<string:rule_id>/
 api.add_resource(CategoriesRoot, '/category')
 api.add_resource(CategoryRoot, '/category/<string:cat_identifier>')
 api.add_resource(CategoryMember, '/category/<string:cat_identifier>/<string:rec_identifier>')
+
+# Background job endpoints
+if _JOBS is not None:
+    api.add_resource(JobsRoot, '/jobs')
+    api.add_resource(JobRoot, '/jobs/<string:job_id>')
@@ -0,0 +1,500 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from csv import Error as CSVError, reader as csv_reader
+from json import dumps, load, loads
+from os import makedirs, replace, scandir, stat
+from os.path import join, exists
+from re import compile as regex_compile
+from sys import exit, stderr
+from time import time
+
+from .compiledvalidator import FIELD_NAME, OBLIGATION, CARDINALITY, \
+    VALUE_TYPE, VALIDATION
+from .recordhistory import RecordHistory
+
+
+# Checks STORAGE_ROOT for the damage non-atomic writes and partial deletes
+# leave behind, optionally repairing it:
+#
+# records/  records which are truncated or otherwise not valid JSON, and
+#           optionally records which fail validation against a conf
+# confs/    conf files the API can never address, and unreadable confs
+# org/      category members pointing at records which no longer exist
+# history/  history for records which no longer exist, and index files
+#           which are missing or disagree with the stored versions
+# tmp/      partial record writes left behind by crashes
+#
+# Anything removed during a repair is moved to STORAGE_ROOT/quarantine
+# rather than deleted outright.
+#
+# A file the API is part way through writing looks just like a damaged
+# one, so files modified after the scan started are skipped rather than
+# judged. Even so, the API should be stopped while running a repair.
+
+_ALPHANUM_PATTERN = regex_compile("^[a-zA-Z0-9]+$")
+_VERSION_FILE_PATTERN = regex_compile(r"^([0-9]+)\.(snapshot|delta)\.json$")
+_CONF_COLUMNS = (FIELD_NAME, OBLIGATION, CARDINALITY, VALUE_TYPE, VALIDATION)
+
+# Set once per worker process, rather than shipping a potentially huge set
+# of identifiers along with every chunk
+_RECORD_IDS = None
+
+
+class ScanError(Exception):
+    # A scan which can't be run as asked, as opposed to problems found in
+    # the storage root
+    pass
+
+
+def _names(path, files=True):
+    try:
+        return sorted(x.name for x in scandir(path)
+                      if (x.is_file() if files else x.is_dir()))
+    except FileNotFoundError:
+        return []
+
+
+def _chunks(names, size):
+    return [names[i:i+size] for i in range(0, len(names), size)]
+
+
+def _quarantine(root, area, name):
+    dest = join(root, 'quarantine', area)
+    makedirs(dest, exist_ok=True)
+    replace(join(root, area, name), join(dest, name))
+
+
+def _finding(area, name, problem, detail="", action=""):
+    return {"area": area, "name": name, "problem": problem,
+            "detail": detail, "action": action}
+
+
+def _changed(path, started):
+    # True if path has been touched (or removed) since the scan started
+    try:
+        return stat(path).st_mtime >= started
+    except FileNotFoundError:
+        return True
+
+
+def _skipped(area, name):
+    return _finding(area, name, "changed_during_scan", action="skipped")
+
+
+def check_records(root, names, repair, started, conf_id=None):
+    findings = []
+    validator = None
+    if conf_id is not None:
+        # Only pull in the record libraries when we have to
+        from hierarchicalrecord.hierarchicalrecord import HierarchicalRecord
+        from hierarchicalrecord.recordconf import RecordConf
+        from hierarchicalrecord.recordvalidator import RecordValidator
+        conf = RecordConf()
+        conf.from_csv(join(root, 'confs', conf_id+".csv"))
+        validator = RecordValidator(conf)
+    for name in names:
+        path = join(root, 'records', name)
+        if not _ALPHANUM_PATTERN.match(name):
+            action = ""
+            if repair:
+                _quarantine(root, 'records', name)
+                action = "quarantined"
+            findings.append(_finding('records', name, "bad_identifier",
+                                     action=action))
+            continue
+        if _changed(path, started):
+            findings.append(_skipped('records', name))
+            continue
+        try:
+            with open(path, 'r') as f:
+                data = load(f)
+            if not isinstance(data, dict):
+                raise ValueError("record is not a JSON object")
+        except ValueError as e:
+            action = ""
+            if repair:
+                action, repaired = _repair_record(root, name, started)
+                findings.extend(repaired)
+            findings.append(_finding('records', name, "corrupt", str(e),
+                                     action))
+            continue
+        if validator is not None:
+            validity = validator.validate(HierarchicalRecord(from_file=path))
+            if not validity[0]:
+                findings.append(_finding('records', name, "invalid",
+                                         "; ".join(str(x) for x in
+                                                   validity[1])))
+    return findings
+
+
+def _repair_record(root, name, started):
+    # Prefer restoring the newest good version from the history, if there
+    # is one, over throwing the record away. Returns the action taken and
+    # anything found fixing up the history on the way.
+    findings = []
+    if exists(join(root, 'history', name)):
+        # The index may be as damaged as the record, so fix it up first
+        findings = check_history(root, [name], True, started,
+                                 record_ids=frozenset([name]))
+    history = RecordHistory(join(root, 'history'))
+    try:
+        versions = history.versions(name)
+    except (OSError, ValueError):
+        # Still unreadable, eg it changed during the scan and was left alone
+        versions = []
+    for v in reversed(versions):
+        try:
+            data = history.get_version(name, v['version'])
+        except (OSError, ValueError, KeyError):
+            continue
+        tmp = join(root, 'records', name + ".tmp")
+        with open(tmp, 'w') as f:
+            f.write(dumps(data))
+        _quarantine(root, 'records', name)
+        replace(tmp, join(root, 'records', name))
+        return "restored version {}".format(v['version']), findings
+    _quarantine(root, 'records', name)
+    return "quarantined", findings
+
+
+def _conf_problem(path):
+    # A csv reader will happily read almost anything, so check the header
+    # has the columns RecordConf writes and every row is as wide as the
+    # header. Returns (problem, detail), or None if it looks like a conf.
+    try:
+        with open(path, 'r', newline='') as f:
+            reader = csv_reader(f)
+            header = next(reader, None)
+            if header is None:
+                # A conf without any rules
+                return None
+            for row in reader:
+                if row and len(row) != len(header):
+                    return ("corrupt",
+                            "line {} has {} fields, expected {}".format(
+                                reader.line_num, len(row), len(header)
+                            ))
+    except (ValueError, CSVError) as e:
+        return ("corrupt", str(e))
+    missing = [x for x in _CONF_COLUMNS if x not in header]
+    if missing:
+        return ("unexpected_columns", "missing {}".format(", ".join(missing)))
+    return None
+
+
+def check_confs(root, names, repair, started):
+    findings = []
+    for name in names:
+        if _changed(join(root, 'confs', name), started):
+            findings.append(_skipped('confs', name))
+            continue
+        stem = name[:-4] if name.endswith(".csv") else None
+        if stem is None or not _ALPHANUM_PATTERN.match(stem):
+            action = ""
+            if repair:
+                _quarantine(root, 'confs', name)
+                action = "quarantined"
+            findings.append(_finding('confs', name, "orphaned",
+                                     action=action))
+            continue
+        problem = _conf_problem(join(root, 'confs', name))
+        if problem is None:
+            continue
+        action = ""
+        # Columns we don't expect may just be a newer RecordConf, so those
+        # are left for a person to look at
+        if repair and problem[0] == "corrupt":
+            _quarantine(root, 'confs', name)
+            action = "quarantined"
+        findings.append(_finding('confs', name, problem[0], problem[1],
+                                 action))
+    return findings
+
+
+def check_tmp(root, names, repair, started):
+    # Record writes land here first and are moved into records/ when
+    # complete, so anything still here is a write that never finished
+    findings = []
+    for name in names:
+        if _changed(join(root, 'tmp', name), started):
+            findings.append(_skipped('tmp', name))
+            continue
+        action = ""
+        if repair:
+            _quarantine(root, 'tmp', name)
+            action = "quarantined"
+        findings.append(_finding('tmp', name, "incomplete_write",
+                                 action=action))
+    return findings
+
+
+def _init_worker(record_ids):
+    global _RECORD_IDS
+    _RECORD_IDS = record_ids
+
+
+def check_categories(root, names, repair, started, record_ids=None):
+    if record_ids is None:
+        record_ids = _RECORD_IDS
+    findings = []
+    for name in names:
+        path = join(root, 'org', name)
+        if _changed(path, started):
+            findings.append(_skipped('org', name))
+            continue
+        with open(path, 'r') as f:
+            members = [x.rstrip('\n') for x in f.readlines()]
+        good = []
+        dangling = []
+        for x in members:
+            if x in record_ids:
+                if x not in good:
+                    good.append(x)
+            elif x:
+                dangling.append(x)
+        action = ""
+        if dangling and repair:
+            tmp = path + ".tmp"
+            with open(tmp, 'w') as f:
+                for x in good:
+                    f.write(x+'\n')
+            replace(tmp, path)
+            action = "removed"
+        for x in dangling:
+            findings.append(_finding('org', name, "dangling_member", x,
+                                     action))
+    return findings
+
+
+def check_history(root, names, repair, started, record_ids=None):
+    if record_ids is None:
+        record_ids = _RECORD_IDS
+    findings = []
+    for name in names:
+        d = join(root, 'history', name)
+        # Adding a version always creates or replaces files in here
+        if _changed(d, started):
+            findings.append(_skipped('history', name))
+            continue
+        if name not in record_ids:
+            action = ""
+            if repair:
+                _quarantine(root, 'history', name)
+                action = "quarantined"
+            findings.append(_finding('history', name, "orphaned",
+                                     action=action))
+            continue
+        # The index is derived from the version files, so rebuild it from
+        # them and see whether it matches
+        versions = {}
+        for x in _names(d):
+            m = _VERSION_FILE_PATTERN.match(x)
+            if m is None:
+                continue
+            v = int(m.group(1))
+            # A snapshot written during compaction supersedes its delta
+            if versions.get(v, (None,))[0] != "snapshot":
+                versions[v] = (m.group(2), stat(join(d, x)).st_mtime)
+        rebuilt = []
+        for v in sorted(versions):
+            if not rebuilt and versions[v][0] != "snapshot":
+                # Nothing to replay these deltas onto
+                continue
+            rebuilt.append({"version": v, "kind": versions[v][0],
+                            "timestamp": versions[v][1]})
+        try:
+            with open(join(d, "index.json"), 'r') as f:
+                index = load(f)
+        except (OSError, ValueError):
+            index = None
+        if index is not None and \
+                [(x['version'], x['kind']) for x in index] == \
+                [(x['version'], x['kind']) for x in rebuilt]:
+            continue
+        action = ""
+        if repair:
+            if index is not None:
+                timestamps = dict((x['version'], x['timestamp'])
+                                  for x in index)
+                for x in rebuilt:
+                    x['timestamp'] = timestamps.get(x['version'],
+                                                    x['timestamp'])
+            tmp = join(d, "index.json.tmp")
+            with open(tmp, 'w') as f:
+                f.write(dumps(rebuilt))
+            replace(tmp, join(d, "index.json"))
+            action = "rebuilt"
+        findings.append(_finding('history', name, "bad_index",
+                                 action=action))
+    return findings
+
+
+class ScanState(object):
+    # Remembers which files have been checked, and what was found in them,
+    # so an interrupted scan can pick up where it left off. The first line
+    # holds the options the scan was started with, since a scan resumed
+    # with different options would give a mix of results.
+    def __init__(self, path, options):
+        self.path = path
+        self.options = options
+        self.done = {}
+        self.findings = {}
+        saved_options = None
+        if path is not None and exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = loads(line)
+                    except ValueError:
+                        # A torn final line from an interrupted run
+                        continue
+                    if saved_options is None:
+                        saved_options = entry.get('options')
+                        if saved_options is None:
+                            raise ScanError(
+                                "{} is not a scan state file".format(path)
+                            )
+                        continue
+                    self.done.setdefault(entry['area'], set()).update(
+                        entry['names']
+                    )
+                    self.findings.setdefault(entry['area'], []).extend(
+                        entry['findings']
+                    )
+        if saved_options is not None and saved_options != options:
+            raise ScanError(
+                "{} was started with different options: {}".format(
+                    path, saved_options
+                )
+            )
+        if path is not None and saved_options is None:
+            with open(path, 'w') as f:
+                f.write(dumps({"options": options})+'\n')
+
+    def record(self, area, names, findings):
+        self.done.setdefault(area, set()).update(names)
+        self.findings.setdefault(area, []).extend(findings)
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(dumps({"area": area, "names": names,
+                               "findings": findings})+'\n')
+
+
+def _run_phase(executor, state, area, func, names, chunk_size, args, quiet):
+    # Only files which haven't been checked yet are chunked up, so files
+    # appearing, disappearing or being quarantined between runs don't
+    # affect what's already been done
+    done = state.done.get(area, set())
+    findings = list(state.findings.get(area, []))
+    todo = [x for x in names if x not in done]
+    total = len(names)
+    finished = total - len(todo)
+    futures = dict(
+        (executor.submit(func, *((args[0], chunk) + args[1:])), chunk)
+        for chunk in _chunks(todo, chunk_size)
+    )
+    for future in as_completed(futures):
+        chunk = futures[future]
+        result = future.result()
+        state.record(area, chunk, result)
+        findings.extend(result)
+        finished += len(chunk)
+        if not quiet:
+            stderr.write("{}: {}/{}\n".format(area, finished, total))
+    return findings
+
+
+def scan(root, repair=False, conf_id=None, workers=None, chunk_size=1000,
+         state_path=None, quiet=False):
+    if conf_id is not None:
+        # Better to find out now than from every worker
+        if not _ALPHANUM_PATTERN.match(conf_id):
+            raise ScanError("Conf identifiers must be alphanumeric.")
+        try:
+            problem = _conf_problem(join(root, 'confs', conf_id+".csv"))
+        except OSError as e:
+            raise ScanError("Can't read conf {}: {}".format(conf_id, e))
+        if problem is not None:
+            raise ScanError("Can't use conf {}: {}".format(conf_id,
+                                                           problem[1]))
+    state = ScanState(state_path, {"repair": repair, "conf_id": conf_id})
+    started = time()
+    findings = []
+    record_names = _names(join(root, 'records'))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        record_findings = _run_phase(
+            executor, state, 'records', check_records, record_names,
+            chunk_size, (root, repair, started, conf_id), quiet
+        )
+        findings.extend(record_findings)
+        findings.extend(_run_phase(
+            executor, state, 'confs', check_confs,
+            _names(join(root, 'confs')), chunk_size,
+            (root, repair, started), quiet
+        ))
+        findings.extend(_run_phase(
+            executor, state, 'tmp', check_tmp,
+            _names(join(root, 'tmp')), chunk_size,
+            (root, repair, started), quiet
+        ))
+    # Members and history are only dangling if the record is gone for
+    # good, so anything repaired in place still counts as existing
+    gone = set(x['name'] for x in record_findings
+               if x['problem'] in ("corrupt", "bad_identifier") and
+               not x['action'].startswith("restored"))
+    record_ids = frozenset(x for x in record_names if x not in gone)
+    # Restoring records already fixed up their history
+    history_done = set(x['name'] for x in record_findings
+                       if x['area'] == 'history')
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(record_ids,)) as executor:
+        findings.extend(_run_phase(
+            executor, state, 'org', check_categories,
+            _names(join(root, 'org')), chunk_size,
+            (root, repair, started), quiet
+        ))
+        findings.extend(_run_phase(
+            executor, state, 'history', check_history,
+            [x for x in _names(join(root, 'history'), files=False)
+             if x not in history_done], chunk_size,
+            (root, repair, started), quiet
+        ))
+    return findings
+
+
+def main():
+    parser = ArgumentParser(
+        description="Check (and optionally repair) a hierarchical " +
+        "records STORAGE_ROOT."
+    )
+    parser.add_argument('storage_root')
+    parser.add_argument('--repair', action='store_true', default=False,
+                        help="Fix problems instead of just reporting them.")
+    parser.add_argument('--conf', dest='conf_id', default=None,
+                        help="Also validate every record against this conf.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Worker processes, defaults to the CPU count.")
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--state', default=None,
+                        help="Progress file, re-use it to resume a scan.")
+    parser.add_argument('--quiet', action='store_true', default=False)
+    args = parser.parse_args()
+
+    try:
+        findings = scan(args.storage_root, repair=args.repair,
+                        conf_id=args.conf_id, workers=args.workers,
+                        chunk_size=args.chunk_size, state_path=args.state,
+                        quiet=args.quiet)
+    except ScanError as e:
+        stderr.write("{}\n".format(e))
+        return 2
+    for x in findings:
+        print("\t".join([x['area'], x['name'], x['problem'],
+                         x['detail'], x['action']]))
+    if any(not x['action'] for x in findings):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
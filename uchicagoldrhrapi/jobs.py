@@ -0,0 +1,292 @@
+from atexit import register as atexit_register
+from json import dump, dumps, load
+from os import O_CREAT, O_EXCL, O_WRONLY, close, getpid, kill, makedirs, \
+    open as os_open, remove, replace, scandir, write
+from os.path import exists, join
+from queue import Queue
+from socket import gethostname
+from threading import Event, Lock, Thread
+from time import time
+from traceback import format_exc
+from uuid import uuid1
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job(object):
+    # Handed to job functions so they can report progress and notice when
+    # they've been cancelled
+    def __init__(self, queue, identifier):
+        self._queue = queue
+        self.identifier = identifier
+        self._cancel = Event()
+        self._last_saved = 0
+
+    def progress(self, done, total=None):
+        # Don't touch the job files on every item of a big job
+        now = time()
+        if now - self._last_saved >= 1 or (total is not None and
+                                           done >= total):
+            self._last_saved = now
+            if self._queue._cancel_requested(self.identifier):
+                self._cancel.set()
+            self.check_cancelled()
+            self._queue._update(self.identifier,
+                                progress={"done": done, "total": total})
+        self.check_cancelled()
+
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        if self.cancelled():
+            raise JobCancelled()
+
+
+class JobQueue(object):
+    # Runs registered job functions on a bounded pool of worker threads,
+    # keeping the state of every job in <root>/<job identifier>.json so it
+    # survives restarts.
+    #
+    # Several processes may share a root. A job only runs in the process
+    # that manages to create its <job identifier>.claim file, and
+    # cancelling a job another process is running leaves a
+    # <job identifier>.cancel file for it to find.
+    #
+    # Jobs which are done are forgotten retention seconds after they
+    # finish, or kept forever if retention is None.
+    def __init__(self, root, workers=2, retention=None):
+        if workers < 1:
+            raise ValueError("Job queues need at least one worker.")
+        if retention is not None and retention < 0:
+            raise ValueError("Job retention can't be negative.")
+        self.root = root
+        self.retention = retention
+        self._kinds = {}
+        self._running = {}
+        self._lock = Lock()
+        self._queue = Queue()
+        self._shutting_down = False
+        makedirs(root, exist_ok=True)
+        # Daemon threads, so a long job can't hold up interpreter exit
+        self._threads = [Thread(target=self._work, daemon=True)
+                         for _ in range(workers)]
+        for t in self._threads:
+            t.start()
+        atexit_register(self.shutdown)
+
+    def register(self, kind, func):
+        # func(job, **params) -> JSON serializable result
+        self._kinds[kind] = func
+
+    def kinds(self):
+        return sorted(self._kinds.keys())
+
+    def _path(self, identifier, suffix=".json"):
+        return join(self.root, identifier+suffix)
+
+    def _read(self, identifier):
+        try:
+            with open(self._path(identifier), 'r') as f:
+                return load(f)
+        except FileNotFoundError:
+            raise ValueError("No job with id {}".format(identifier))
+
+    def _write(self, state):
+        tmp = self._path(state['job_identifier'], ".json.tmp")
+        with open(tmp, 'w') as f:
+            dump(state, f)
+        replace(tmp, self._path(state['job_identifier']))
+
+    def _update(self, identifier, **changes):
+        with self._lock:
+            state = self._read(identifier)
+            state.update(changes)
+            self._write(state)
+            return state
+
+    def _claim(self, identifier):
+        try:
+            fd = os_open(self._path(identifier, ".claim"),
+                         O_CREAT | O_EXCL | O_WRONLY)
+        except FileExistsError:
+            return False
+        try:
+            write(fd, dumps({"host": gethostname(),
+                             "pid": getpid()}).encode("utf-8"))
+        finally:
+            close(fd)
+        return True
+
+    def _claim_is_live(self, identifier):
+        try:
+            with open(self._path(identifier, ".claim"), 'r') as f:
+                claim = load(f)
+        except (OSError, ValueError):
+            return False
+        if claim['host'] != gethostname():
+            # No way to tell, so leave it to its own host
+            return True
+        try:
+            kill(claim['pid'], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _cancel_requested(self, identifier):
+        return exists(self._path(identifier, ".cancel"))
+
+    def resume(self):
+        # Pick back up after a restart: queued jobs run again, but jobs
+        # whose process died part way through can't be trusted to be rerun
+        # blindly
+        if self.retention is not None:
+            self.purge(self.retention)
+        for x in scandir(self.root):
+            if not x.is_file() or not x.name.endswith(".json"):
+                continue
+            identifier = x.name[:-5]
+            try:
+                state = self._read(identifier)
+            except ValueError:
+                # Purged by another process since we listed it
+                continue
+            if state['status'] == "queued":
+                self._start(identifier, state['kind'], state['params'])
+            elif state['status'] == "running" and \
+                    not self._claim_is_live(identifier):
+                self._update(identifier, status="interrupted",
+                             finished=time())
+
+    def purge(self, max_age):
+        # Remove everything about jobs which are done and finished more
+        # than max_age seconds ago. Returns the purged job identifiers.
+        purged = []
+        cutoff = time() - max_age
+        for identifier in self.list():
+            try:
+                state = self.get(identifier)
+            except ValueError:
+                continue
+            if state['status'] in ("queued", "running") or \
+                    state['finished'] is None or state['finished'] > cutoff:
+                continue
+            # The state file goes last, so a purge interrupted part way is
+            # picked up again by the next one
+            for suffix in (".cancel", ".claim", ".json"):
+                try:
+                    remove(self._path(identifier, suffix))
+                except FileNotFoundError:
+                    pass
+            purged.append(identifier)
+        return purged
+
+    def submit(self, kind, params=None):
+        if kind not in self._kinds:
+            raise ValueError(
+                "Unknown job kind {}, must be one of: {}".format(
+                    kind, ", ".join(self.kinds())
+                )
+            )
+        if params is None:
+            params = {}
+        if self.retention is not None:
+            self.purge(self.retention)
+        identifier = uuid1().hex
+        with self._lock:
+            self._write({"job_identifier": identifier,
+                         "kind": kind,
+                         "params": params,
+                         "status": "queued",
+                         "progress": {"done": 0, "total": None},
+                         "result": None,
+                         "error": None,
+                         "submitted": time(),
+                         "started": None,
+                         "finished": None})
+        self._start(identifier, kind, params)
+        return self.get(identifier)
+
+    def _start(self, identifier, kind, params):
+        job = Job(self, identifier)
+        with self._lock:
+            self._running[identifier] = job
+        self._queue.put((job, kind, params))
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._run(*item)
+
+    def _run(self, job, kind, params):
+        try:
+            if self._shutting_down:
+                # Leave it queued for the next process to pick up
+                return
+            if not self._claim(job.identifier):
+                # Someone else got to it first
+                return
+            if job.cancelled() or self._cancel_requested(job.identifier):
+                raise JobCancelled()
+            self._update(job.identifier, status="running", started=time())
+            result = self._kinds[kind](job, **params)
+            self._update(job.identifier, status="finished", result=result,
+                         finished=time())
+        except JobCancelled:
+            self._update(job.identifier,
+                         status="interrupted" if self._shutting_down
+                         else "cancelled",
+                         finished=time())
+        except Exception as e:
+            self._update(job.identifier, status="failed",
+                         error={"message": str(e), "traceback": format_exc()},
+                         finished=time())
+        finally:
+            with self._lock:
+                self._running.pop(job.identifier, None)
+
+    def get(self, identifier):
+        with self._lock:
+            return self._read(identifier)
+
+    def list(self):
+        with self._lock:
+            return sorted(
+                (x.name[:-5] for x in scandir(self.root)
+                 if x.is_file() and x.name.endswith(".json")),
+            )
+
+    def cancel(self, identifier):
+        with self._lock:
+            job = self._running.get(identifier)
+            state = self._read(identifier)
+        if state['status'] not in ("queued", "running"):
+            raise ValueError(
+                "Job {} has already {}.".format(identifier, state['status'])
+            )
+        # Running jobs stop at their next progress report, queued ones
+        # never start, whichever process they're in
+        with open(self._path(identifier, ".cancel"), 'w'):
+            pass
+        if job is not None:
+            job._cancel.set()
+        return state
+
+    def shutdown(self, timeout=10):
+        # Stop running jobs at their next progress report, giving them a
+        # little while to record that they were interrupted
+        self._shutting_down = True
+        with self._lock:
+            for job in self._running.values():
+                job._cancel.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        deadline = time() + timeout
+        for t in self._threads:
+            t.join(max(0, deadline - time()))
@@ -0,0 +1,64 @@
+from json import dumps as _std_dumps, loads as _std_loads
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# JSON encoding/decoding through orjson when it's installed, otherwise the
+# standard library. orjson can't handle everything the standard library
+# can (eg ints wider than 64 bits), so those fall back to the standard
+# library too.
+#
+# Both produce compact UTF-8, but the bytes aren't always identical: the
+# main difference is that orjson writes NaN and Infinity as null, where
+# the standard library writes (non-standard) NaN and Infinity.
+
+def std_dumps(obj):
+    return _std_dumps(obj, separators=(",", ":"),
+                      ensure_ascii=False).encode("utf-8")
+
+
+def std_loads(s):
+    if isinstance(s, bytes):
+        s = s.decode("utf-8")
+    return _std_loads(s)
+
+
+def fast_dumps(obj):
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+    return std_dumps(obj)
+
+
+def fast_loads(s):
+    if orjson is not None:
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            pass
+    return std_loads(s)
+
+
+class FastJSONModule(object):
+    # Enough of the json module to stand in for it as a werkzeug
+    # Request.json_module. Bad JSON still raises a ValueError, which is
+    # what werkzeug expects.
+    @staticmethod
+    def loads(s, **kwargs):
+        return fast_loads(s)
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return fast_dumps(obj).decode("utf-8")
+
+
+def codec(fast):
+    # (dumps, loads), picked once by callers rather than on every call
+    if fast and orjson is not None:
+        return fast_dumps, fast_loads
+    return std_dumps, std_loads
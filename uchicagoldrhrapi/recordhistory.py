@@ -0,0 +1,179 @@
+from copy import deepcopy
+from json import dump, load
+from os import makedirs, remove, replace
+from os.path import join, isdir
+from shutil import rmtree
+from threading import Lock
+from time import time
+
+
+_MISSING = object()
+
+
+def diff(old, new, path=None):
+    # Structural delta between two record trees. Dicts are diffed key by
+    # key, anything else (including lists) is replaced wholesale.
+    if path is None:
+        path = []
+    ops = []
+    for k, v in new.items():
+        o = old.get(k, _MISSING)
+        if o is _MISSING:
+            ops.append(["set", path + [k], v])
+        elif isinstance(o, dict) and isinstance(v, dict):
+            ops.extend(diff(o, v, path + [k]))
+        elif o != v or type(o) is not type(v):
+            ops.append(["set", path + [k], v])
+    for k in old:
+        if k not in new:
+            ops.append(["del", path + [k]])
+    return ops
+
+
+def patch(data, ops):
+    for op in ops:
+        node = data
+        for k in op[1][:-1]:
+            node = node[k]
+        if op[0] == "set":
+            node[op[1][-1]] = deepcopy(op[2])
+        elif op[0] == "del":
+            del node[op[1][-1]]
+        else:
+            raise ValueError("Unknown delta operation: {}".format(op[0]))
+    return data
+
+
+class RecordHistory(object):
+    # Stores every version of a record as a delta against the version
+    # before it, with a full snapshot every snapshot_interval versions so
+    # rebuilding any version never replays more than that many deltas.
+    #
+    # <root>/<identifier>/index.json lists the stored versions, and each
+    # version lives in <root>/<identifier>/<version>.<kind>.json
+    def __init__(self, root, snapshot_interval=10, max_versions=None):
+        if snapshot_interval < 1:
+            raise ValueError("Snapshot intervals must be at least 1.")
+        if max_versions is not None and max_versions < 1:
+            raise ValueError("Must keep at least one version.")
+        self.root = root
+        self.snapshot_interval = snapshot_interval
+        self.max_versions = max_versions
+        self._lock = Lock()
+        makedirs(root, exist_ok=True)
+
+    def _dir(self, identifier):
+        return join(self.root, identifier)
+
+    def _path(self, identifier, entry):
+        return join(self._dir(identifier),
+                    "{}.{}.json".format(entry['version'], entry['kind']))
+
+    def _write_json(self, path, obj):
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            dump(obj, f)
+        replace(tmp, path)
+
+    def _read_json(self, path):
+        with open(path, 'r') as f:
+            return load(f)
+
+    def _read_index(self, identifier):
+        try:
+            return self._read_json(join(self._dir(identifier), "index.json"))
+        except FileNotFoundError:
+            return []
+
+    def _write_index(self, identifier, index):
+        self._write_json(join(self._dir(identifier), "index.json"), index)
+
+    def _reconstruct(self, identifier, index, version):
+        position = None
+        for i, x in enumerate(index):
+            if x['version'] == version:
+                position = i
+        if position is None:
+            raise ValueError(
+                "No version {} of record {}".format(version, identifier)
+            )
+        start = position
+        while index[start]['kind'] != "snapshot":
+            start -= 1
+        data = self._read_json(self._path(identifier, index[start]))
+        for x in index[start+1:position+1]:
+            patch(data, self._read_json(self._path(identifier, x)))
+        return data
+
+    def add_version(self, identifier, data):
+        with self._lock:
+            makedirs(self._dir(identifier), exist_ok=True)
+            index = self._read_index(identifier)
+            if index:
+                version = index[-1]['version'] + 1
+                since_snapshot = 0
+                for x in reversed(index):
+                    if x['kind'] == "snapshot":
+                        break
+                    since_snapshot += 1
+            if not index or since_snapshot + 1 >= self.snapshot_interval:
+                kind = "snapshot"
+                payload = data
+                if not index:
+                    version = 1
+            else:
+                kind = "delta"
+                payload = diff(
+                    self._reconstruct(identifier, index, index[-1]['version']),
+                    data
+                )
+            entry = {"version": version, "kind": kind, "timestamp": time()}
+            self._write_json(self._path(identifier, entry), payload)
+            index.append(entry)
+            self._write_index(identifier, index)
+        if self.max_versions is not None and len(index) > self.max_versions:
+            self.compact(identifier, self.max_versions)
+        return version
+
+    def versions(self, identifier):
+        with self._lock:
+            return [{"version": x['version'], "timestamp": x['timestamp']}
+                    for x in self._read_index(identifier)]
+
+    def get_version(self, identifier, version):
+        with self._lock:
+            return self._reconstruct(identifier, self._read_index(identifier),
+                                     version)
+
+    def compact(self, identifier, keep):
+        # Drop all but the newest keep versions, turning the oldest kept
+        # version into a snapshot so it can still be rebuilt
+        if keep < 1:
+            raise ValueError("Must keep at least one version.")
+        with self._lock:
+            index = self._read_index(identifier)
+            if len(index) <= keep:
+                return 0
+            dropped = index[:-keep]
+            kept = index[-keep:]
+            if kept[0]['kind'] != "snapshot":
+                # The delta file stays in place until the index no longer
+                # refers to it, so a crash part way through is harmless
+                dropped.append(kept[0])
+                kept[0] = dict(kept[0], kind="snapshot")
+                self._write_json(
+                    self._path(identifier, kept[0]),
+                    self._reconstruct(identifier, index, kept[0]['version'])
+                )
+            self._write_index(identifier, kept)
+            for x in dropped:
+                try:
+                    remove(self._path(identifier, x))
+                except FileNotFoundError:
+                    pass
+            return len(index) - len(kept)
+
+    def delete(self, identifier):
+        with self._lock:
+            if isdir(self._dir(identifier)):
+                rmtree(self._dir(identifier))
@@ -0,0 +1,84 @@
+from atexit import register as atexit_register
+from copy import deepcopy
+from threading import Event, Lock, Thread
+
+
+class WriteBehindBuffer(object):
+    # Holds the latest state of recently written objects in memory and
+    # hands them to writer(identifier, obj, fsync) once per interval, so
+    # that bursts of writes to the same identifier become a single write.
+    def __init__(self, writer, interval):
+        if interval <= 0:
+            raise ValueError("Write behind intervals must be positive.")
+        self._writer = writer
+        self._interval = interval
+        self._pending = {}
+        self._lock = Lock()
+        # Held while writing so a flush can't race a newer flush of the
+        # same identifier and leave stale data on disk
+        self._write_lock = Lock()
+        self._closed = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit_register(self.close)
+
+    def _run(self):
+        while not self._closed.wait(self._interval):
+            self.flush()
+
+    def put(self, identifier, obj):
+        obj = deepcopy(obj)
+        with self._lock:
+            self._pending[identifier] = obj
+
+    def get(self, identifier):
+        # Callers are free to mutate what they get back, so never hand out
+        # the pending copy itself
+        with self._lock:
+            obj = self._pending.get(identifier)
+        if obj is None:
+            return None
+        return deepcopy(obj)
+
+    def discard(self, identifier):
+        with self._write_lock:
+            with self._lock:
+                return self._pending.pop(identifier, None) is not None
+
+    def pending_identifiers(self):
+        with self._lock:
+            return list(self._pending.keys())
+
+    def flush(self, identifier=None, fsync=False):
+        with self._write_lock:
+            # Entries stay pending (and so readable through get()) until
+            # they're safely on disk
+            with self._lock:
+                if identifier is None:
+                    batch = dict(self._pending)
+                elif identifier in self._pending:
+                    batch = {identifier: self._pending[identifier]}
+                else:
+                    batch = {}
+            error = None
+            for k, v in batch.items():
+                try:
+                    self._writer(k, v, fsync)
+                except Exception as e:
+                    # Background flushes just try again next interval
+                    error = e
+                    continue
+                with self._lock:
+                    # put() always stores a fresh copy, so anything else
+                    # here is a newer write which still needs flushing
+                    if self._pending.get(k) is v:
+                        del self._pending[k]
+            # Someone waiting on a specific identifier needs to know
+            if error is not None and identifier is not None:
+                raise error
+
+    def close(self):
+        if not self._closed.is_set():
+            self._closed.set()
+            self._thread.join()
+        self.flush()